@@ -1,26 +1,55 @@
+import functools
 import numpy as np
-import random
-import copy
-from maze_utilities import MazeState, MazePlayer, MazeBeast, Maze, QMazeSimulation
+import checkpoint
+from instrumentation import RingBuffer
+from replay_buffer import ReplayBuffer
+from state_space import StateSpace
+from optimal_control import reward_vector
+from convergence import ConvergenceMonitor
+from collections.abc import Mapping
+from maze_utilities import MazeState, MazePlayer, MazeBeast, Maze, QMazeSimulation, BatchedQMazeSimulation, \
+    ACTION_CODES
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 DEBUG = False
 
 
-def log(s):
+def log(*parts):
+    # Parts are only formatted when debugging, so that the calls in the loops cost nothing otherwise
     if DEBUG:
-        print(s)
+        print(''.join(str(part) for part in parts))
 
 class QLearning:
-    def __init__(self, simulation_environment, num_iterations, lmb, player_possible_actions, police_possible_actions):
+    def __init__(self, simulation_environment, num_iterations, lmb, player_possible_actions, police_possible_actions,
+                 q_table=None, tracer=None, history_every=1, history_capacity=None, state_space=None,
+                 update_rule=None):
         self.player_possible_actions = player_possible_actions
         self.police_possible_actions = police_possible_actions
         self.simulation_environment = simulation_environment
         self.lmb = lmb
         self.q_function = None
         self.num_iterations = num_iterations
-        self.q_initial_state_history = []
-        self.init_q_function()
+        # Q value of the initial state every history_every iterations, in a buffer preallocated for the whole run
+        # unless a smaller history_capacity is given
+        self.history_every = history_every
+        if history_capacity is None:
+            history_capacity = -(-num_iterations // history_every)
+        self.q_initial_state_history = RingBuffer(history_capacity)
+        self.tracer = tracer
+        self.td_error = 0.0
+        # Where simulate_and_learn starts from; set when resuming from a checkpoint
+        self.iteration = 0
+        self.resume_states = None
+        self.sampler_state = None
+        # Optional state_space.StateSpace (compiled with player_walls=False and absorbing=False, as the simulations
+        # run) the Q function is allocated over
+        assert state_space is None or not (state_space.absorbing or state_space.player_walls), \
+            "The learner needs a state space compiled with absorbing=False and player_walls=False"
+        self.state_space = state_space
+        # Optional multistep_q_learning rule (NStepQ, WatkinsQLambda) simulate_and_learn updates with, instead of
+        # the one step update_q
+        self.update_rule = update_rule
+        self.init_q_function(q_table)
 
     @staticmethod
     def reward_function(player_state, police_state, goal_state):
@@ -32,15 +61,73 @@ class QLearning:
 
         return 0
 
-    def simulate_and_learn(self):
+    def simulate_and_learn(self, checkpoint_path=None, checkpoint_every=100000, monitor=None):
+        """
+        Learn from num_iterations simulated transitions, or until the convergence.ConvergenceMonitor monitor, if
+        given, finds the Q function converged.
+        """
+        player, police = self.init_simulation()
+        simulation = self.simulation_environment
+        goal_state = simulation.maze.goal_state
+        action_index = self.q_table.action_index
+        update = self.update_q
+        if self.update_rule is not None:
+            # The returns and traces of the rule start empty, also when resuming from a checkpoint
+            self.update_rule.reset()
+            update = functools.partial(self.update_rule.update, self)
+
+        tracer = self.tracer
+        if tracer is not None:
+            run_start = tracer.now()
+        state = simulation.encode_state()
+        for i in tqdm(range(self.iteration, self.num_iterations), initial=self.iteration, total=self.num_iterations):
+            log()
+            log('Learning step: ', i)
+            log('     Player state: ', player.state.x, ', ', player.state.y)
+            log('     Police state: ', police.state.x, ', ', police.state.y)
+            if tracer is not None:
+                start = tracer.now()
+            reward = self.reward_function(player_state=player.state, police_state=police.state, goal_state=goal_state)
+            log('            Reward collected: ', reward)
+            p_action, _ = simulation.step_simulation()
+            next_state = simulation.encode_state()
+            log('            Action chosen: ', p_action)
+            if tracer is not None:
+                tracer.stop('simulate', start)
+                start = tracer.now()
+            q_initial_state_t = update(state, action_index[p_action], reward, next_state)
+            state = next_state
+            if tracer is not None:
+                tracer.stop('update', start)
+                tracer.count('transitions')
+                tracer.record('td_error', self.td_error)
+                tracer.record('q_initial_state', q_initial_state_t)
+            if i % self.history_every == 0:
+                self.q_initial_state_history.append(q_initial_state_t)
+            self.iteration = i + 1
+            if checkpoint_path is not None and self.iteration % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path)
+            if monitor is not None and monitor.update(self):
+                log('Converged after ', self.iteration, ' iterations')
+                break
+        if tracer is not None:
+            tracer.stop('simulate_and_learn', run_start)
+
+    def init_simulation(self):
         # Initialize states
         # Notice that the player is also a beast since it can choose randomly. Needed for exploration purposes
         player_init_state = MazeState(0, 0)
+        police_init_state = MazeState(3, 3)
+        if self.resume_states is not None:
+            player_init_state, police_init_state = self.resume_states
+            self.resume_states = None
+        if self.sampler_state is not None:
+            self.simulation_environment.sampler.setstate(self.sampler_state)
+            self.sampler_state = None
         player = MazeBeast(init_state=player_init_state, maze = self.simulation_environment.maze,
                            possible_actions=self.player_possible_actions)
-        police_init_state = MazeState(3, 3)
         police = MazeBeast(init_state=police_init_state, maze = self.simulation_environment.maze,
-                           possible_actions=self.player_possible_actions)
+                           possible_actions=self.police_possible_actions)
 
         # Plug the player inside the simulation environment
         self.simulation_environment.player = player
@@ -48,88 +135,294 @@ class QLearning:
 
         # Initialize simulation
         self.simulation_environment.step = 0
-        # Initialize the memory for the simulation_step
-        memory = {'state_agent_0': None, 'state_police_0': None, 'reward': None, 'action': None, 'state_agent_1': None,
-                  'state_police_1': None}
-
-        for i in tqdm(range(self.num_iterations)):
-            log('')
-            log('Learning step: ' + str(i))
-            log('     Player state: ' + str(player.state.x) + ', ' + str(player.state.y))
-            log('     Police state: ' + str(police.state.x) + ', ' + str(police.state.y))
-            memory['state_agent_0'] = copy.deepcopy(player.state)
-            memory['state_police_0'] = copy.deepcopy(police.state)
-            memory['reward'] = self.reward_function(player_state=player.state, police_state=police.state,
-                                                              goal_state=self.simulation_environment.maze.goal_state)
-            log('            Reward collected: ' + str(memory['reward']))
-            p_action, _ = self.simulation_environment.step_simulation()
-            memory['state_agent_1'] = copy.deepcopy(player.state)
-            memory['state_police_1'] = copy.deepcopy(police.state)
-            memory['action'] = p_action
-            log('            Action chosen: ' + str(memory['action']))
-            q_initial_state_t = self.update_q_function(memory)
-            self.q_initial_state_history.append(q_initial_state_t)
-
-    def init_q_function(self):
-        seq = []
-        for x_p in range(self.simulation_environment.maze.length):
-            for y_p in range(self.simulation_environment.maze.height):
-                for x_b in range(self.simulation_environment.maze.length):
-                    for y_b in range(self.simulation_environment.maze.height):
-                        for action in self.player_possible_actions:
-                            seq.append((x_p, y_p, x_b, y_b, action))
-        # Store in the dictionary, the value of the Q function and the number of updates
-        self.q_function = dict.fromkeys(seq)
-
-        for x_p in range(self.simulation_environment.maze.length):
-            for y_p in range(self.simulation_environment.maze.height):
-                for x_b in range(self.simulation_environment.maze.length):
-                    for y_b in range(self.simulation_environment.maze.height):
-                        for action in self.player_possible_actions:
-                            self.q_function[(x_p, y_p, x_b, y_b, action)] = [0.1, 0]
+        return player, police
+
+    def simulate_and_learn_replay(self, buffer_capacity=100000, batch_size=32, train_every=1, warmup=1000,
+                                  seed=None):
+        """
+        Learn from minibatches drawn from a replay buffer fed by the experience stream of the simulation. Every
+        train_every simulated steps, batch_size stored transitions are replayed through batch_update_q_function,
+        so each simulated transition is used batch_size / train_every times on average.
+        """
+        self.init_simulation()
+        buffer = ReplayBuffer(buffer_capacity)
+        rng = np.random.default_rng(seed)
+        stream = self.simulation_environment.experience(self.player_possible_actions, self.reward_function,
+                                                        self.num_iterations - self.iteration)
+        tracer = self.tracer
+        if tracer is not None:
+            run_start = tracer.now()
+        q_initial_state_t = self.q_initial_state()
+        for state, action, reward, next_state in tqdm(stream, initial=self.iteration, total=self.num_iterations):
+            buffer.add(state, action, reward, next_state)
+            if len(buffer) >= warmup and self.iteration % train_every == 0:
+                states, actions, rewards, next_states = buffer.sample(batch_size, rng)
+                q_initial_state_t = self.batch_update_q_function(states, actions, rewards, next_states)
+            if tracer is not None:
+                tracer.count('transitions')
+                tracer.record('q_initial_state', q_initial_state_t)
+            if self.iteration % self.history_every == 0:
+                self.q_initial_state_history.append(q_initial_state_t)
+            self.iteration += 1
+        if tracer is not None:
+            tracer.stop('simulate_and_learn', run_start)
+
+    def q_initial_state(self):
+        return float(self.q_table.q[self.initial_row, self.initial_state_actions].max())
+
+    def save_checkpoint(self, path):
+        """
+        Save the Q function, the update counts and everything needed to resume simulate_and_learn where it is.
+        """
+        agent_states = None
+        if self.simulation_environment.player is not None and self.simulation_environment.beast is not None:
+            player_state = self.simulation_environment.player.state
+            police_state = self.simulation_environment.beast.state
+            agent_states = [[player_state.x, player_state.y], [police_state.x, police_state.y]]
+        meta = {'maze': checkpoint.maze_to_meta(self.simulation_environment.maze),
+                'player_possible_actions': self.player_possible_actions,
+                'police_possible_actions': self.police_possible_actions,
+                'lmb': self.lmb,
+                'num_iterations': self.num_iterations,
+                'iteration': self.iteration,
+                'history_every': self.history_every,
+                'history_capacity': self.q_initial_state_history.capacity,
+                'agent_states': agent_states,
+                'sampler_state': self.simulation_environment.sampler.getstate(),
+                'state_space': None if self.q_table.state_space is None else self.q_table.state_space.to_meta()}
+        arrays = {'q': self.q_table.q, 'n': self.q_table.n,
+                  'q_initial_state_history': np.asarray(self.q_initial_state_history, dtype=np.float64)}
+        checkpoint.save_checkpoint(path, 'q_learning', arrays, meta)
+
+    @classmethod
+    def load_checkpoint(cls, path, mmap=False):
+        """
+        Rebuild a QLearning experience from save_checkpoint. With mmap the Q function is a read-only view on the
+        file, for evaluation only; without it the experience can resume training with simulate_and_learn.
+        """
+        meta, arrays = checkpoint.load_checkpoint(path, 'q_learning', mmap=mmap)
+        maze = checkpoint.maze_from_meta(meta['maze'])
+        space = None
+        if meta.get('state_space') is not None:
+            # Compiling again from the same start states gives back the same rows
+            space = StateSpace(maze, meta['player_possible_actions'], meta['police_possible_actions'],
+                               **meta['state_space'])
+        q_table = QTable(maze, meta['player_possible_actions'], q=arrays['q'], n=arrays['n'], state_space=space)
+        q_learning = cls(QMazeSimulation(maze=maze), meta['num_iterations'], meta['lmb'],
+                         meta['player_possible_actions'], meta['police_possible_actions'], q_table=q_table,
+                         history_every=meta.get('history_every', 1), history_capacity=meta.get('history_capacity'))
+        q_learning.q_initial_state_history.extend(arrays['q_initial_state_history'])
+        q_learning.iteration = meta['iteration']
+        if meta['agent_states'] is not None:
+            q_learning.resume_states = tuple(MazeState(x, y) for x, y in meta['agent_states'])
+        # Checkpoints of the former random module based simulations cannot replay their draws
+        q_learning.sampler_state = meta.get('sampler_state')
+        return q_learning
+
+    def simulate_and_learn_batched(self, num_envs=256, seed=None):
+        """
+        Same learning as simulate_and_learn, with num_envs player/police pairs stepped at once and their
+        transitions applied to the Q function in batch. num_iterations counts the transitions of all the pairs.
+        """
+        simulation = self.init_batched_simulation(num_envs, seed)
+        self.learn_batched(simulation, self.reward_table(), -(-self.num_iterations // num_envs))
+
+    def init_batched_simulation(self, num_envs, seed=None):
+        simulation = BatchedQMazeSimulation(self.simulation_environment.maze, self.player_possible_actions,
+                                            self.police_possible_actions, num_envs, rng=np.random.default_rng(seed))
+        simulation.reset(MazeState(0, 0), MazeState(3, 3))
+        return simulation
+
+    def learn_batched(self, simulation, rewards, num_steps, progress=True):
+        n_cells = self.q_table.n_cells
+        tracer = self.tracer
+        if tracer is not None:
+            run_start = tracer.now()
+        for i in tqdm(range(num_steps), disable=not progress):
+            if tracer is not None:
+                start = tracer.now()
+            states = simulation.player_cells * n_cells + simulation.beast_cells
+            p_actions, _ = simulation.step_simulation()
+            next_states = simulation.player_cells * n_cells + simulation.beast_cells
+            if tracer is not None:
+                tracer.stop('simulate', start)
+                start = tracer.now()
+            q_initial_state_t = self.batch_update_q_function(states, p_actions, rewards[states], next_states)
+            if tracer is not None:
+                tracer.stop('update', start)
+                tracer.count('transitions', len(states))
+                tracer.record('q_initial_state', q_initial_state_t)
+            if i % self.history_every == 0:
+                self.q_initial_state_history.append(q_initial_state_t)
+        if tracer is not None:
+            tracer.stop('simulate_and_learn', run_start)
+
+    def reward_table(self):
+        # reward_function evaluated once for every encoded state
+        def reward_function(t, maze, beast_state, player_state, action, final):
+            return self.reward_function(player_state=player_state, police_state=beast_state,
+                                        goal_state=maze.goal_state)
+
+        n_cells = self.q_table.n_cells
+        return reward_vector(reward_function, self.simulation_environment.maze, np.arange(n_cells * n_cells), 0,
+                             final=False)
+
+    def batch_update_q_function(self, states, actions, rewards, next_states):
+        """
+        Apply a batch of transitions given as arrays of encoded states and action indices. The targets are computed
+        from the Q function before the batch; when the same (s, a) appears several times, its updates are applied
+        one after the other, exactly as the sequential updates of update_q_function would be.
+        """
+        q = self.q_table.q
+        q_flat = q.reshape(-1)
+        n_flat = self.q_table.n.reshape(-1)
+        n_actions = q.shape[1]
+        rows = self.q_table.rows[states]
+        next_rows = self.q_table.rows[next_states]
+        if (rows < 0).any() or (next_rows < 0).any():
+            raise KeyError('Transitions out of the state space of the Q table')
+
+        future_q = np.where(self.player_feasible[next_states // self.q_table.n_cells], q[next_rows], -np.inf)
+        targets = rewards + self.lmb * future_q.max(axis=1)
 
+        # Rank of each transition among the ones sharing its (s, a): the k-th duplicates are applied in round k
+        keys = rows * n_actions + actions
+        if self.tracer is not None:
+            self.tracer.record_many('td_error', targets - q_flat[keys])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        group_start = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        group_sizes = np.diff(np.r_[group_start, len(keys)])
+        ranks = np.arange(len(keys)) - np.repeat(group_start, group_sizes)
+        for k in range(group_sizes.max()):
+            batch = order[ranks == k]
+            idx = keys[batch]
+            n_flat[idx] += 1
+            q_flat[idx] += self.step_size(n_flat[idx]) * (targets[batch] - q_flat[idx])
+
+        return self.q_initial_state()
+
+    def init_q_function(self, q_table=None):
+        # Store in contiguous arrays the value of the Q function and the number of updates
+        maze = self.simulation_environment.maze
+        if q_table is None:
+            q_table = QTable(maze, self.player_possible_actions, init_value=0.1, state_space=self.state_space)
+        self.q_table = q_table
+        self.q_function = self.q_table
+        # Actions the player may pick from each cell, used for the max over the future Q values
+        tables = maze.tables()
+        codes = [ACTION_CODES[action] for action in self.player_possible_actions]
+        self.player_feasible = tables.feasible(tables.player_masks, codes).T
+        self.initial_state = self.q_table.encode_state(0, 0, 3, 3)
+        self.initial_row = self.q_table.state_row(self.initial_state)
+        self.initial_state_actions = [self.q_table.action_index[a] for a in ['stay', 'right', 'down']]
 
     def update_q_function(self, memory):
+        # MazeState based entry point of update_q
         state_player = memory['state_agent_0']
         state_police = memory['state_police_0']
-        reward = memory['reward']
         next_state_player = memory['state_agent_1']
         next_state_police = memory['state_police_1']
-        action = memory['action']
-        current_state_action = (state_player.x, state_player.y, state_police.x, state_police.y, action)
+        s = self.q_table.encode_state(state_player.x, state_player.y, state_police.x, state_police.y)
+        s_next = self.q_table.encode_state(next_state_player.x, next_state_player.y,
+                                           next_state_police.x, next_state_police.y)
+        return self.update_q(s, self.q_table.action_index[memory['action']], memory['reward'], s_next)
 
-        log('    Updating Q in: ' + '(' + str(state_player.x) + str(', ') + str(state_player.y) + ')')
-        log('    Possible Q to be picked, given future state: ' +
-            '(' + str(next_state_player.x) + str(', ') + str(next_state_player.y) + ')')
-        possible_future_q = []
-
-        for p_action in self.player_possible_actions:
-            if self.simulation_environment.maze.check_player_action(action=p_action, state=state_player):
-                future_state = (next_state_player.x, next_state_player.y, next_state_police.x, next_state_police.y, p_action)
-                log('        '+str(self.q_function[future_state][0]))
-                possible_future_q.append(self.q_function[future_state][0])
+    def update_q(self, s, a, reward, s_next):
+        """
+        One step TD backup of the encoded transition (s, a, reward, s_next); returns the Q value of the initial state.
+        """
+        q = self.q_table.q
+        n = self.q_table.n
+        log('    Updating Q in state: ', s)
+        # Rows of the states in q and n
+        row = self.q_table.state_row(s)
+        next_row = self.q_table.state_row(s_next)
+        possible_future_q = q[next_row][self.player_feasible[s_next // self.q_table.n_cells]]
+        log('    Possible Q to be picked, given future state ', s_next, ': ', possible_future_q)
+        max_future_q = possible_future_q.max()
 
         # update n_t
-        self.q_function[current_state_action][1] = self.q_function[current_state_action][1] + 1
-        n = self.q_function[current_state_action][1]
+        n[row, a] += 1
 
         # update q(s, a)
-        self.q_function[current_state_action][0] = \
-            self.q_function[current_state_action][0] + \
-            self.step_size(n) * (reward + self.lmb * max(possible_future_q) - self.q_function[current_state_action][0])
-
-        q_initial_state = []
-        for p_action in ['stay', 'right', 'down']:
-            q_initial_state.append(self.q_function[(0, 0, 3, 3, p_action)][0])
-
-        return max(q_initial_state)
+        self.td_error = reward + self.lmb * max_future_q - q[row, a]
+        q[row, a] += self.step_size(int(n[row, a])) * self.td_error
 
+        return self.q_initial_state()
 
     @staticmethod
     def step_size(n):
         return 1/(n**(3/3))
 
 
+class QTable(Mapping):
+    """
+    Q values and update counts of every (x_p, y_p, x_b, y_b, action) kept in contiguous arrays q and n.
+    The state is encoded as player_cell * n_cells + beast_cell, with cell = x * height + y, and the action by its
+    position in the list of actions. Read as a mapping it behaves like the former dict:
+    q_table[(x_p, y_p, x_b, y_b, action)] -> (q, n)
+    With a state_space the arrays only have its rows: q[rows[s]] holds encoded state s, and unreachable states
+    are not keys.
+    """
+    def __init__(self, maze, actions, init_value=0.1, q=None, n=None, state_space=None):
+        self.length = maze.length
+        self.height = maze.height
+        self.n_cells = maze.length * maze.height
+        self.actions = list(actions)
+        self.action_index = {action: i for i, action in enumerate(self.actions)}
+        self.state_space = state_space
+        if state_space is None:
+            self.rows = np.arange(self.n_cells * self.n_cells)
+            shape = (self.n_cells * self.n_cells, len(self.actions))
+        else:
+            self.rows = state_space.index
+            shape = (state_space.n_rows, len(self.actions))
+        self.q = np.full(shape, init_value, dtype=np.float64) if q is None else q
+        self.n = np.zeros(shape, dtype=np.int32) if n is None else n
+        assert self.q.shape == shape and self.n.shape == shape, "Q table arrays do not match the maze and actions"
+
+    def cell_id(self, x, y):
+        return x * self.height + y
+
+    def encode_state(self, x_p, y_p, x_b, y_b):
+        return (x_p * self.height + y_p) * self.n_cells + x_b * self.height + y_b
+
+    def decode_state(self, s):
+        player_cell, beast_cell = divmod(s, self.n_cells)
+        return player_cell // self.height, player_cell % self.height, beast_cell // self.height, beast_cell % self.height
+
+    def state_row(self, s):
+        # Row of encoded state s in q and n
+        row = self.rows[s]
+        if row < 0:
+            raise KeyError('State ' + str(s) + ' is not in the state space of the Q table')
+        return row
+
+    def encode(self, key):
+        x_p, y_p, x_b, y_b, action = key
+        if not (0 <= x_p < self.length and 0 <= y_p < self.height and
+                0 <= x_b < self.length and 0 <= y_b < self.height and action in self.action_index):
+            raise KeyError(key)
+        return self.encode_state(x_p, y_p, x_b, y_b), self.action_index[action]
+
+    def __getitem__(self, key):
+        s, a = self.encode(key)
+        row = self.rows[s]
+        if row < 0:
+            raise KeyError(key)
+        return float(self.q[row, a]), int(self.n[row, a])
+
+    def __iter__(self):
+        for s in np.flatnonzero(self.rows >= 0).tolist():
+            state = self.decode_state(s)
+            for action in self.actions:
+                yield state + (action,)
+
+    def __len__(self):
+        return int((self.rows >= 0).sum()) * len(self.actions)
+
+
 def main():
     bank_location = MazeState(1, 1)
     bank_maze = Maze(4, 4, goal_state=bank_location)
@@ -144,9 +437,13 @@ def main():
                                       num_iterations=num_iterations,
                                       lmb=lmb,
                                       player_possible_actions=player_actions,
-                                      police_possible_actions=police_actions)
-    q_learning_experience.simulate_and_learn()
+                                      police_possible_actions=police_actions,
+                                      history_every=100)
+    # num_iterations is only an upper bound: stop once the greedy values are close to the Bellman solution
+    monitor = ConvergenceMonitor.for_experience(q_learning_experience, check_every=20000, mean_value_tol=0.5)
+    q_learning_experience.simulate_and_learn(monitor=monitor)
     q_function = q_learning_experience.q_function
+    print(monitor.history[-1])
     print(q_learning_experience.q_initial_state_history[-10:])
     plt.plot(q_learning_experience.q_initial_state_history)
     plt.show()
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import numpy as np
+from collections import OrderedDict
+import checkpoint
+
+
+def solution_key(maze, player_actions, beast_actions, rewards):
+    """
+    Canonical hash of everything a Bellman solution depends on but its horizon. The walls enter through the
+    compiled feasibility tables, so two mazes whose walls are listed differently but block the same moves share
+    their solutions. The rewards enter through the arrays of their values, whatever function computed them.
+    """
+    tables = maze.tables()
+    h = hashlib.sha256()
+    h.update(repr((maze.length, maze.height, maze.goal_state.x, maze.goal_state.y,
+                   list(player_actions), list(beast_actions))).encode('utf-8'))
+    h.update(tables.player_masks.tobytes())
+    h.update(tables.beast_masks.tobytes())
+    for array in rewards:
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class BellmanCache:
+    """
+    Solutions of BellmansOptimizer (numpy backend) keyed by solution_key, kept in memory with LRU eviction and,
+    when cache_dir is given, on disk as checkpoint files that are memory mapped back.
+
+    The rewards and the dynamics must not depend on t, which is why time_dependent_rewards are refused, and the
+    reward values are part of the key. Then the solution of horizon T0 is the tail of every longer one: a cached
+    T0 >= T answers T by slicing, and a cached T0 < T is extended with T - T0 backward steps only.
+    """
+    def __init__(self, max_entries=16, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def solve(self, optimizer):
+        if optimizer.time_dependent_rewards:
+            raise ValueError('Solutions of rewards that depend on t cannot be sliced or extended, nor cached')
+        r_final, r_step, _ = optimizer.reward_arrays()
+        key = solution_key(optimizer.maze, optimizer.player_actions, optimizer.beast_actions, (r_final, r_step))
+        cached = self.lookup(key)
+        if cached is not None and len(cached[0]) > optimizer.T:
+            self.hits += 1
+            values, actions = cached
+            start = len(values) - optimizer.T - 1
+            optimizer.set_solution(values[start:], actions[start:])
+            return
+        self.misses += 1
+        if cached is None:
+            optimizer.solve_bellman_numpy()
+        else:
+            optimizer.solve_bellman_numpy(initial_values=cached[0], initial_actions=cached[1])
+        self.store(key, optimizer)
+
+    def lookup(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        path = self.path(key)
+        if path is not None and os.path.exists(path):
+            meta, arrays = checkpoint.load_checkpoint(path, 'bellman', mmap=True)
+            self.insert(key, (arrays['values'], arrays['actions']))
+            return self.entries[key]
+        return None
+
+    def store(self, key, optimizer):
+        self.insert(key, (optimizer.values, optimizer.actions))
+        path = self.path(key)
+        if path is not None:
+            optimizer.save_solution(path)
+
+    def insert(self, key, solution):
+        self.entries[key] = solution
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + '.ckpt')
+
+    def clear(self):
+        self.entries.clear()
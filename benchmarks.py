@@ -0,0 +1,210 @@
+"""
+Timings of the solver and learner hot paths over maze sizes, wall counts, horizons and iteration counts.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --output new.json --compare results.json --tolerance 1.2
+
+Every case runs in its own process so that its peak RSS is not hidden by the previous ones. Results are written
+as JSON; with --compare the wall times are checked against a previous run, and the exit code is 1 when a case
+got slower than tolerance times its baseline.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing as mp
+import platform
+import random
+import resource
+import sys
+import time
+import numpy as np
+from maze_utilities import Maze, MazeState, MazePlayer, MazeBeast, QMazeSimulation, ACTIONS
+from optimal_control import BellmansOptimizer
+from Q_learning import QLearning
+
+PLAYER_ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+BEAST_ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_maze(size, num_walls, seed=0):
+    # Square maze with num_walls random interior walls of length up to a third of the side
+    rng = random.Random(seed)
+    maze = Maze(size, size, goal_state=MazeState(size - 1, size - 1))
+    for _ in range(num_walls):
+        start = rng.randrange(size)
+        stop = min(size - 1, start + rng.randrange(max(1, size // 3)))
+        if rng.random() < 0.5:
+            maze.add_vert_wall(rng.randrange(size - 1), start, stop)
+        else:
+            maze.add_horiz_wall(rng.randrange(size - 1), start, stop)
+    return maze
+
+
+def bench_solve_bellman(size, num_walls, T, backend):
+    maze = build_maze(size, num_walls)
+    player = MazePlayer(MazeState(0, 0), maze, possible_actions=PLAYER_ACTIONS)
+    if backend == 'python':
+        player.init_policies()
+    optimizer = BellmansOptimizer(player, maze, PLAYER_ACTIONS, BEAST_ACTIONS, T, backend=backend)
+    start = time.perf_counter()
+    optimizer.solve_bellman()
+    elapsed = time.perf_counter() - start
+    # One transition is one (state, player action, beast move) term of a backup
+    return elapsed, (size * size) ** 2 * T * len(PLAYER_ACTIONS) * len(BEAST_ACTIONS)
+
+
+def bench_update_q_function(size, num_walls, iterations):
+    maze = build_maze(size, num_walls)
+    q_learning = QLearning(QMazeSimulation(maze=maze), iterations, 0.8, PLAYER_ACTIONS, BEAST_ACTIONS[:4])
+    rng = random.Random(0)
+    memories = []
+    for _ in range(min(iterations, 10000)):
+        x_p, y_p, x_b, y_b = (rng.randrange(size) for _ in range(4))
+        memories.append({'state_agent_0': MazeState(x_p, y_p), 'state_police_0': MazeState(x_b, y_b),
+                         'state_agent_1': MazeState(x_p, y_p), 'state_police_1': MazeState(x_b, y_b),
+                         'reward': 0, 'action': 'stay'})
+    start = time.perf_counter()
+    for i in range(iterations):
+        q_learning.update_q_function(memories[i % len(memories)])
+    return time.perf_counter() - start, iterations
+
+
+def bench_step_simulation(size, num_walls, iterations):
+    maze = build_maze(size, num_walls)
+    simulation = QMazeSimulation(maze=maze,
+                                 player=MazeBeast(MazeState(0, 0), maze, possible_actions=PLAYER_ACTIONS),
+                                 beast=MazeBeast(MazeState(size - 1, 0), maze, possible_actions=BEAST_ACTIONS),
+                                 rng=np.random.default_rng(0))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        simulation.step_simulation()
+    return time.perf_counter() - start, iterations
+
+
+def bench_check_action(size, num_walls, iterations, agent):
+    maze = build_maze(size, num_walls)
+    check = maze.check_player_action if agent == 'player' else maze.check_beast_action
+    rng = random.Random(0)
+    queries = [(rng.choice(ACTIONS), MazeState(rng.randrange(size), rng.randrange(size))) for _ in range(1000)]
+    check('stay', MazeState(0, 0))
+    start = time.perf_counter()
+    for i in range(iterations):
+        action, state = queries[i % 1000]
+        check(action, state)
+    return time.perf_counter() - start, iterations
+
+
+BENCHMARKS = {
+    'solve_bellman': bench_solve_bellman,
+    'update_q_function': bench_update_q_function,
+    'step_simulation': bench_step_simulation,
+    'check_action': bench_check_action,
+}
+
+
+def run_case(name, params, connection):
+    # Keep stdout for the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        elapsed, transitions = BENCHMARKS[name](**params)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    connection.send({'wall_time': elapsed, 'peak_rss': peak_rss, 'transitions_per_sec': transitions / elapsed})
+    connection.close()
+
+
+def run_isolated(name, params):
+    # A fresh interpreter rather than a fork, whose peak RSS would start from the one of this process
+    context = mp.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(name, params, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {'error': 'benchmark process exited with code ' + str(process.exitcode)}
+    return result
+
+
+def build_cases(args):
+    cases = []
+    for size in args.sizes:
+        for num_walls in args.walls:
+            for T in args.horizons:
+                cases.append(('solve_bellman', {'size': size, 'num_walls': num_walls, 'T': T, 'backend': 'numpy'}))
+                if size <= args.python_max_size:
+                    cases.append(('solve_bellman', {'size': size, 'num_walls': num_walls, 'T': T,
+                                                    'backend': 'python'}))
+            for iterations in args.iterations:
+                cases.append(('update_q_function', {'size': size, 'num_walls': num_walls, 'iterations': iterations}))
+                cases.append(('step_simulation', {'size': size, 'num_walls': num_walls, 'iterations': iterations}))
+                for agent in ('player', 'beast'):
+                    cases.append(('check_action', {'size': size, 'num_walls': num_walls, 'iterations': iterations,
+                                                   'agent': agent}))
+    return cases
+
+
+def case_key(case):
+    return case['name'] + json.dumps(case['params'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the wall time ratio of every case found in both runs to stderr, so that the JSON results on stdout stay
+    parsable, and return the cases slower than tolerance.
+    """
+    baseline_cases = {case_key(case): case for case in baseline['cases'] if 'wall_time' in case}
+    regressions = []
+    for case in results['cases']:
+        reference = baseline_cases.get(case_key(case))
+        if reference is None or 'wall_time' not in case:
+            continue
+        ratio = case['wall_time'] / reference['wall_time']
+        flag = ' REGRESSION' if ratio > tolerance else ''
+        print('{0:<80} {1:8.3f}x{2}'.format(case_key(case), ratio, flag), file=sys.stderr)
+        if ratio > tolerance:
+            regressions.append(case)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 10, 20, 50])
+    parser.add_argument('--walls', type=int, nargs='+', default=[0, 50])
+    parser.add_argument('--horizons', type=int, nargs='+', default=[5, 15])
+    parser.add_argument('--iterations', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--python-max-size', type=int, default=6,
+                        help='largest maze solved with the python backend of solve_bellman')
+    parser.add_argument('--output', help='JSON file the results are written to (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare the wall times against')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='slowdown ratio above which a case is reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+               'cases': []}
+    for name, params in build_cases(args):
+        result = run_isolated(name, params)
+        results['cases'].append(dict(name=name, params=params, **result))
+        print(name, params, result, file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
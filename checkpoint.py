@@ -0,0 +1,81 @@
+"""
+Checkpoint files: an 8 bytes magic, the format version and the header length as little endian uint32, a JSON
+header, then the raw C-ordered arrays, each starting at a multiple of ALIGNMENT so that they can be np.memmap-ed.
+"""
+import json
+import os
+import numpy as np
+from maze_utilities import Maze, MazeState
+
+MAGIC = b'RLMAZECK'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def save_checkpoint(path, kind, arrays, meta):
+    descriptors = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        descriptors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'kind': kind, 'meta': meta, 'arrays': descriptors}).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    # Written next to the target and renamed, so that a run dying mid-save never leaves a truncated checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([FORMAT_VERSION, len(header)], dtype='<u4').tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + descriptors[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, kind, mmap=True):
+    """
+    Returns (meta, arrays). With mmap the arrays are read-only views on the file, shared between all the processes
+    mapping it; otherwise they are private, writable copies.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a maze checkpoint')
+        version, header_len = np.frombuffer(f.read(8), dtype='<u4')
+        if version > FORMAT_VERSION:
+            raise ValueError(path + ' has checkpoint format ' + str(version) + ', newer than the supported '
+                             + str(FORMAT_VERSION))
+        header = json.loads(f.read(int(header_len)).decode('utf-8'))
+    if header['kind'] != kind:
+        raise ValueError(path + ' holds a ' + header['kind'] + ' checkpoint, not a ' + kind + ' one')
+    data_start = -(-(len(MAGIC) + 8 + int(header_len)) // ALIGNMENT) * ALIGNMENT
+
+    arrays = {}
+    for name, descriptor in header['arrays'].items():
+        dtype = np.dtype(descriptor['dtype'])
+        shape = tuple(descriptor['shape'])
+        offset = data_start + descriptor['offset']
+        if mmap and int(np.prod(shape)) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return header['meta'], arrays
+
+
+def maze_to_meta(maze):
+    return {'length': maze.length, 'height': maze.height,
+            'goal_state': [maze.goal_state.x, maze.goal_state.y],
+            'vert_walls': maze.vert_walls, 'horiz_walls': maze.horiz_walls,
+            'outer_vert_walls': maze.outer_vert_walls, 'outer_horiz_walls': maze.outer_horiz_walls}
+
+
+def maze_from_meta(meta):
+    maze = Maze(meta['length'], meta['height'], goal_state=MazeState(*meta['goal_state']))
+    maze.vert_walls = meta['vert_walls']
+    maze.horiz_walls = meta['horiz_walls']
+    maze.outer_vert_walls = meta['outer_vert_walls']
+    maze.outer_horiz_walls = meta['outer_horiz_walls']
+    maze._tables = None
+    return maze
@@ -0,0 +1,88 @@
+"""
+Online convergence monitoring of Q-learning runs, against the value function of a discounted Bellman solve of
+the same maze, with early stopping.
+"""
+import numpy as np
+from discounted_control import DiscountedBellmanOptimizer
+from instrumentation import RingBuffer
+from maze_utilities import MazePlayer, MazeState
+
+
+def reference_values(q_learning, tol=1e-10):
+    """
+    Optimal values V*(s) = max_a Q*(s, a) of the problem a QLearning experience learns, as a flat array over the
+    encoded states: the rewards of QLearning.reward_function, discounted by lmb, without absorbing states. The
+    player moves as in the maze model, where the inner walls block it.
+    """
+    maze = q_learning.simulation_environment.maze
+
+    def reward_function(t, maze, beast_state, player_state, action, final):
+        return q_learning.reward_function(player_state=player_state, police_state=beast_state,
+                                          goal_state=maze.goal_state)
+
+    player = MazePlayer(MazeState(0, 0), maze, q_learning.player_possible_actions)
+    optimizer = DiscountedBellmanOptimizer(player, maze, q_learning.player_possible_actions,
+                                           q_learning.police_possible_actions, gamma=q_learning.lmb,
+                                           reward_function=reward_function, absorbing=False)
+    return optimizer.value_iteration(tol=tol).reshape(-1)
+
+
+class ConvergenceMonitor:
+    """
+    Called by QLearning.simulate_and_learn after every transition. Keeps the last window absolute TD errors and,
+    every check_every transitions, compares the greedy values max_a Q(s, a) of the visited states with the
+    reference values. Training stops at a check where every threshold given is met:
+        value_tol: max |max_a Q(s, a) - V*(s)| over the visited states
+        mean_value_tol: mean of the same errors
+        td_tol: mean absolute TD error over the window
+    history holds the measures of every check.
+    """
+    def __init__(self, reference, check_every=10000, window=10000, value_tol=None, mean_value_tol=None,
+                 td_tol=None):
+        assert any(tol is not None for tol in (value_tol, mean_value_tol, td_tol)), "No stopping threshold given"
+        self.reference = np.asarray(reference).reshape(-1)
+        self.check_every = check_every
+        self.value_tol = value_tol
+        self.mean_value_tol = mean_value_tol
+        self.td_tol = td_tol
+        self.td_errors = RingBuffer(window)
+        self.history = []
+        self.stopped_at = None
+
+    @classmethod
+    def for_experience(cls, q_learning, **kwargs):
+        # Monitor against the discounted Bellman solution of the experience's own maze and rewards
+        return cls(reference_values(q_learning), **kwargs)
+
+    def update(self, q_learning):
+        # Returns True when training should stop
+        self.td_errors.append(abs(q_learning.td_error))
+        if q_learning.iteration % self.check_every:
+            return False
+        return self.check(q_learning)
+
+    def value_errors(self, q_learning):
+        q_table = q_learning.q_table
+        states = np.flatnonzero(q_table.rows >= 0)
+        rows = q_table.rows[states]
+        visited = q_table.n[rows].sum(axis=1) > 0
+        states, rows = states[visited], rows[visited]
+        feasible = q_learning.player_feasible[states // q_table.n_cells]
+        greedy = np.where(feasible, q_table.q[rows], -np.inf).max(axis=1)
+        return np.abs(greedy - self.reference[states])
+
+    def check(self, q_learning):
+        errors = self.value_errors(q_learning)
+        td_errors = self.td_errors.values()
+        measures = {'iteration': q_learning.iteration, 'visited_states': len(errors),
+                    'max_value_error': float(errors.max()) if len(errors) else float('inf'),
+                    'mean_value_error': float(errors.mean()) if len(errors) else float('inf'),
+                    'max_td_error': float(td_errors.max()) if len(td_errors) else float('inf'),
+                    'mean_td_error': float(td_errors.mean()) if len(td_errors) else float('inf')}
+        self.history.append(measures)
+        converged = ((self.value_tol is None or measures['max_value_error'] <= self.value_tol) and
+                     (self.mean_value_tol is None or measures['mean_value_error'] <= self.mean_value_tol) and
+                     (self.td_tol is None or measures['mean_td_error'] <= self.td_tol))
+        if converged:
+            self.stopped_at = q_learning.iteration
+        return converged
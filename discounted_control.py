@@ -0,0 +1,244 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from collections.abc import Mapping, Sequence
+from maze_model import build_mdp
+from optimal_control import compute_transition_tables
+
+DEBUG = False
+# Krylov vectors kept by the policy evaluation solves: a few times the memory of the values
+GMRES_RESTART = 20
+
+
+def log(*parts):
+    # Parts are only formatted when debugging, so that the calls in the loops cost nothing otherwise
+    if DEBUG:
+        print(''.join(str(part) for part in parts))
+
+
+class DiscountedBellmanOptimizer():
+    """
+    Stationary optimal control of the player against the random beast with discounted rewards:
+        V(s) = r(s) + gamma * max_a E[V(s') | s, a]
+    on the same model as BellmansOptimizer, where r(s) is the final reward of the reward function, collected at
+    every step. With absorbing the goal and the capture cells keep the agents in place, as in the finite horizon
+    game. The Bellman backups are sparse mat-vec products with the transition matrices of maze_model, and only
+    O(|S|.|A|) memory is used, whatever the number of iterations.
+    """
+    def __init__(self, player, maze, player_actions, beast_actions, gamma=0.95, reward_function=None, absorbing=True,
+                 tracer=None):
+        assert 0 <= gamma < 1, "The discount factor must be in [0, 1)"
+        self.player = player
+        self.maze = maze
+        self.player_actions = player_actions
+        self.beast_actions = beast_actions
+        self.gamma = gamma
+        # Optional instrumentation.Tracer timing the sweeps and recording their Bellman residuals
+        self.tracer = tracer
+        self.model = build_mdp(maze, player_actions, beast_actions, reward_function, absorbing)
+        self.n_cells = self.model.n_cells
+        self.rewards = self.model.final_rewards.reshape(self.n_cells, self.n_cells)
+        self.absorbing_states = self.model.absorbing.reshape(self.n_cells, self.n_cells)
+        # Solution, as (n_cells, n_cells) arrays over (player cell, beast cell)
+        self.values = np.zeros((self.n_cells, self.n_cells))
+        self.policy = None
+        self.residuals = []
+
+    def q_values(self, values, rows=slice(None)):
+        """
+        Q(s, a) of the player cells selected by the slice rows, as a (n_actions, n_rows, n_cells) array; infeasible
+        actions are -inf.
+        """
+        start, stop, _ = rows.indices(self.n_cells)
+        states = slice(start * self.n_cells, stop * self.n_cells)
+        if rows == slice(None):
+            states = None
+        expected = self.model.expected_values(values, states)
+        q = self.rewards[rows].reshape(1, -1) + self.gamma * expected
+        return q.reshape(len(self.player_actions), stop - start, self.n_cells)
+
+    def value_iteration(self, tol=1e-6, max_iterations=10000, in_place=False, block_size=None):
+        """
+        Iterate the Bellman operator until the residual max|TV - V| drops below tol. With in_place the sweeps are
+        Gauss-Seidel: V is updated block by block of block_size player cells (default: one column of the maze),
+        and later blocks already see the new values.
+        """
+        if block_size is None:
+            block_size = self.maze.height
+        values = self.values
+        if in_place:
+            # Absorbing states only loop on themselves, their fixed point is known
+            values[self.absorbing_states] = self.rewards[self.absorbing_states] / (1 - self.gamma)
+        self.residuals = []
+        for iteration in range(max_iterations):
+            if self.tracer is not None:
+                start = self.tracer.now()
+            if in_place:
+                residual = 0
+                for block_start in range(0, self.n_cells, block_size):
+                    rows = slice(block_start, min(block_start + block_size, self.n_cells))
+                    new_values = self.q_values(values, rows).max(axis=0)
+                    residual = max(residual, np.abs(new_values - values[rows]).max())
+                    values[rows] = new_values
+            else:
+                new_values = self.q_values(values).max(axis=0)
+                residual = np.abs(new_values - values).max()
+                values = new_values
+            self.residuals.append(float(residual))
+            if self.tracer is not None:
+                self.tracer.stop('value_iteration_sweep', start)
+                self.tracer.count('states', self.model.n_states)
+                self.tracer.record('bellman_residual', residual)
+            log('Value iteration ', iteration, ', Bellman residual: ', residual)
+            if residual < tol:
+                break
+        self.values = values
+        self.update_policy()
+        return self.values
+
+    def prioritized_sweeping(self, tol=1e-6, max_backups=None):
+        """
+        Asynchronous value iteration on the blocks of states of one player cell, each backed up as a whole with a
+        single sparse product, largest Bellman error first. Each block has an upper bound of the errors of its
+        states: the exact errors to start with, 0 once backed up, and, when its values change by at most delta,
+        gamma * delta more for each block the player can move in from (its own included, the beast moving within
+        it). The block of largest bound is backed up next, until no bound is above tol, hence no Bellman error
+        either. The values spread out from the rewarded cells, and the blocks are backed up about in that order, far
+        fewer times than by the in place sweeps, which go over every column of the maze until the last one settles.
+        max_backups bounds the number of states backed up.
+        """
+        model = self.model
+        n = self.n_cells
+        n_actions = len(self.player_actions)
+        player_next, player_feasible, _, _ = compute_transition_tables(self.maze, self.player_actions,
+                                                                       self.beast_actions)
+        # Cells the player can come from, with a feasible action, for each cell
+        predecessors = [[] for _ in range(n)]
+        for i, cell in zip(*np.nonzero(player_feasible)):
+            predecessors[player_next[i, cell]].append(cell)
+        predecessors = [np.unique(cells) for cells in predecessors]
+        # The rows of every action for the states of a block, contiguous: block p is rows [p, p + 1) * n_actions * n
+        order = (np.arange(n_actions)[None, :, None] * model.n_states + np.arange(model.n_states).reshape(n, 1, n))
+        transitions = sp.vstack(model.transitions).tocsr()[order.reshape(-1)]
+        blocks = [transitions[p * n_actions * n:(p + 1) * n_actions * n] for p in range(n)]
+        values = self.values
+        # Absorbing states only loop on themselves, their fixed point is known
+        values[self.absorbing_states] = self.rewards[self.absorbing_states] / (1 - self.gamma)
+
+        def backup(p):
+            expected = (blocks[p] @ values.reshape(-1)).reshape(n_actions, n)
+            expected[~model.feasible[:, p * n:(p + 1) * n]] = -np.inf
+            return self.rewards[p] + self.gamma * expected.max(axis=0)
+
+        bounds = np.abs(self.q_values(values).max(axis=0) - values).max(axis=1)
+        backups = 0
+        while max_backups is None or backups < max_backups:
+            p = int(np.argmax(bounds))
+            if bounds[p] <= tol:
+                break
+            if self.tracer is not None:
+                start = self.tracer.now()
+            new_values = backup(p)
+            change = np.abs(new_values - values[p]).max()
+            values[p] = new_values
+            backups += n
+            bounds[p] = 0
+            bounds[predecessors[p]] += self.gamma * change
+            if self.tracer is not None:
+                self.tracer.stop('prioritized_sweeping_block', start)
+                self.tracer.count('states', n)
+            log('Prioritized sweeping: ', backups, ' backups, change of cell ', p, ': ', change)
+        self.values = values
+        self.residuals = [float(np.abs(self.q_values(values).max(axis=0) - values).max())]
+        self.update_policy()
+        return self.values
+
+    def policy_iteration(self, tol=1e-8, max_iterations=100):
+        """
+        Alternate policy evaluation, an iterative sparse solve of (I - gamma P_pi) V = r warm started from the
+        previous values, and greedy improvement until no action improves a value by more than tol.
+        """
+        if self.policy is None:
+            self.update_policy()
+        self.residuals = []
+        for iteration in range(max_iterations):
+            if self.tracer is not None:
+                start = self.tracer.now()
+            self.values = self.evaluate_policy(self.policy, self.values, tol)
+            q = self.q_values(self.values)
+            greedy = np.argmax(q, axis=0)
+            # Keep the current action on ties, within the accuracy of the evaluation, so that the iteration cannot
+            # cycle between equivalent policies
+            current = np.take_along_axis(q, self.policy[None].astype(np.intp), axis=0)[0]
+            best = np.take_along_axis(q, greedy[None], axis=0)[0]
+            improved = best > current + tol
+            self.residuals.append(float(np.abs(best - self.values).max()))
+            if self.tracer is not None:
+                self.tracer.stop('policy_iteration_step', start)
+                self.tracer.record('bellman_residual', self.residuals[-1])
+            log('Policy iteration ', iteration, ', changed actions: ', improved.sum())
+            if not improved.any():
+                break
+            self.policy = np.where(improved, greedy, self.policy).astype(np.uint8)
+        self.set_policies()
+        return self.values
+
+    def evaluate_policy(self, policy, values=None, tol=1e-8):
+        """
+        Values of policy, by restarted GMRES from the initial guess values: no factorization is stored, only the
+        sparse system. The residual is brought below tol * (1 - gamma), which bounds the error of the values by about
+        tol.
+        """
+        n_states = self.n_cells * self.n_cells
+        system = sp.identity(n_states, format='csr') - self.gamma * self.model.policy_transitions(policy)
+        x0 = None if values is None else values.reshape(-1)
+        values, info = spla.gmres(system, self.rewards.reshape(-1), x0=x0, rtol=0, atol=tol * (1 - self.gamma),
+                                  restart=GMRES_RESTART, maxiter=n_states)
+        if info != 0:
+            raise ArithmeticError('Policy evaluation did not converge (GMRES info ' + str(info) + ')')
+        return values.reshape(self.n_cells, self.n_cells)
+
+    def update_policy(self):
+        self.policy = np.argmax(self.q_values(self.values), axis=0).astype(np.uint8)
+        self.set_policies()
+
+    def set_policies(self):
+        shape = (self.maze.length, self.maze.height, self.maze.length, self.maze.height)
+        self.player.policies = StationaryPolicies(self.policy.reshape(shape), self.values.reshape(shape),
+                                                  self.player_actions)
+
+
+class StationaryPolicies(Mapping):
+    """
+    Read only MazePlayer.policies view of a stationary solution: policies[(x_p, y_p, x_b, y_b)][-(t+1)] gives
+    the same (action, value) for every t.
+    """
+    def __init__(self, actions, values, player_actions):
+        self.actions = actions
+        self.values = values
+        self.player_actions = player_actions
+
+    def __getitem__(self, state):
+        if len(state) != 4 or not all(0 <= c < n for c, n in zip(state, self.actions.shape)):
+            raise KeyError(state)
+        return StationaryStatePolicy(self.player_actions[self.actions[tuple(state)]], float(self.values[tuple(state)]))
+
+    def __iter__(self):
+        return iter(np.ndindex(*self.actions.shape))
+
+    def __len__(self):
+        return self.actions.size
+
+
+class StationaryStatePolicy(Sequence):
+    def __init__(self, action, value):
+        self.entry = (action, value)
+
+    def __getitem__(self, i):
+        # Any time step -(t+1) answers the same entry
+        if i > 0:
+            raise IndexError('stationary policies only have one entry')
+        return self.entry
+
+    def __len__(self):
+        return 1
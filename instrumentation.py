@@ -0,0 +1,139 @@
+"""
+Optional metrics of the training and solving loops. The loops take a tracer=None argument and only touch it
+behind an `if tracer is not None` check, so nothing is timed, allocated or formatted when tracing is off.
+"""
+import time
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated float64 buffer keeping the last capacity values appended. Reads as a sequence in append order.
+    """
+    def __init__(self, capacity):
+        self.data = np.empty(max(int(capacity), 1))
+        self.count = 0
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    def append(self, value):
+        self.data[self.count % len(self.data)] = value
+        self.count += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def values(self):
+        if self.count <= len(self.data):
+            return self.data[:self.count].copy()
+        start = self.count % len(self.data)
+        return np.concatenate([self.data[start:], self.data[:start]])
+
+    def __len__(self):
+        return min(self.count, len(self.data))
+
+    def __getitem__(self, i):
+        return self.values()[i]
+
+    def __iter__(self):
+        return iter(self.values().tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values()
+        return values if dtype is None else values.astype(dtype)
+
+
+class RunningStats:
+    # Welford's mean and variance, with the extremes
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        delta = values.mean() - self.mean
+        self.m2 += ((values - values.mean()) ** 2).sum() + delta ** 2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def summary(self):
+        std = (self.m2 / self.count) ** 0.5 if self.count else 0.0
+        return {'count': self.count, 'mean': float(self.mean), 'std': float(std), 'min': self.min, 'max': self.max}
+
+
+class Tracer:
+    """
+    Collects, for the loops it is given to:
+        phase timers: total wall time and number of calls of named phases
+        counters: e.g. the number of transitions, from which the rates are derived
+        series: every sample_every-th recorded value of a metric (TD error, Bellman residual, Q traces...) kept in
+                a RingBuffer of the given capacity, with running statistics over the sampled values
+    """
+    def __init__(self, capacity=4096, sample_every=1):
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self.timers = {}
+        self.counters = {}
+        self.series = {}
+        self.stats = {}
+        self.calls = {}
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def stop(self, phase, start):
+        # Close a phase opened with start = tracer.now()
+        timer = self.timers.get(phase)
+        if timer is None:
+            timer = self.timers[phase] = [0.0, 0]
+        timer[0] += time.perf_counter() - start
+        timer[1] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, value):
+        calls = self.calls.get(name, 0)
+        self.calls[name] = calls + 1
+        if calls % self.sample_every:
+            return
+        if name not in self.series:
+            self.series[name] = RingBuffer(self.capacity)
+            self.stats[name] = RunningStats()
+        self.series[name].append(value)
+        self.stats[name].update(value)
+
+    def record_many(self, name, values):
+        # A batch of values counts as one call; the sample keeps its mean and its statistics all of them
+        calls = self.calls.get(name, 0)
+        self.calls[name] = calls + 1
+        if calls % self.sample_every:
+            return
+        if name not in self.series:
+            self.series[name] = RingBuffer(self.capacity)
+            self.stats[name] = RunningStats()
+        self.series[name].append(float(np.mean(values)))
+        self.stats[name].update(values)
+
+    def rate(self, counter, phase):
+        timer = self.timers.get(phase)
+        if timer is None or timer[0] == 0:
+            return 0.0
+        return self.counters.get(counter, 0) / timer[0]
+
+    def summary(self):
+        return {'timers': {phase: {'total': total, 'calls': calls} for phase, (total, calls) in self.timers.items()},
+                'counters': dict(self.counters),
+                'stats': {name: stats.summary() for name, stats in self.stats.items()}}
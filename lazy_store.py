@@ -0,0 +1,193 @@
+import numpy as np
+
+EMPTY = -1
+# Fibonacci hashing: the high bits of key * 2^64 / golden ratio spread consecutive keys over the whole table
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_MASK = 2 ** 64 - 1
+
+
+class HashedTable:
+    """
+    Open addressing hash table from non-negative integer keys to rows of fields, with linear probing. Every array
+    is preallocated for capacity slots (a power of two), so the memory never grows: entries are only allocated for
+    the keys that are inserted, and once more than max_load * capacity are held, maintain() evicts the least
+    recently used ones down to evict_to * capacity and rehashes the others. Pinned keys are never evicted.
+    fields are (name, dtype, shape, fill) specs; each field is an attribute of shape (capacity,) + shape, where a
+    new entry starts filled with fill.
+    Slots only stay valid until the next maintain(), which callers run between their batches of lookups.
+    """
+    def __init__(self, capacity, fields, max_load=0.75, evict_to=0.5):
+        assert capacity & (capacity - 1) == 0 and capacity >= 2, "The capacity must be a power of two"
+        assert 0 < evict_to < max_load < 1, "Need 0 < evict_to < max_load < 1"
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.shift = 64 - (capacity.bit_length() - 1)
+        self.max_load = max_load
+        self.evict_to = evict_to
+        self.fields = [(name, np.dtype(dtype), tuple(shape), fill) for name, dtype, shape, fill in fields]
+        self.keys = np.full(capacity, EMPTY, dtype=np.int64)
+        # Time of the last access of each slot, and the keys protected from eviction
+        self.stamps = np.zeros(capacity, dtype=np.int64)
+        self.pinned = np.zeros(capacity, dtype=np.bool_)
+        for name, dtype, shape, fill in self.fields:
+            setattr(self, name, np.full((capacity,) + shape, fill, dtype=dtype))
+        self.clock = 0
+        self.size = 0
+        self.evictions = 0
+
+    def hash(self, key):
+        return ((key * HASH_MULTIPLIER) & HASH_MASK) >> self.shift
+
+    def find(self, key):
+        # Slot of key, or -1 when it is not held
+        key = int(key)
+        i = self.hash(key)
+        keys = self.keys
+        while True:
+            k = keys[i]
+            if k == key:
+                self.clock += 1
+                self.stamps[i] = self.clock
+                return int(i)
+            if k == EMPTY:
+                return -1
+            i = (i + 1) & self.mask
+
+    def slot(self, key):
+        # Slot of key, inserted with the fill values of the fields if it is not held
+        key = int(key)
+        i = self.hash(key)
+        keys = self.keys
+        while True:
+            k = keys[i]
+            if k == key:
+                break
+            if k == EMPTY:
+                if self.size + 1 >= self.capacity:
+                    raise MemoryError('Hashed table full: call maintain() between batches of insertions')
+                keys[i] = key
+                self.size += 1
+                break
+            i = (i + 1) & self.mask
+        self.clock += 1
+        self.stamps[i] = self.clock
+        return int(i)
+
+    def find_many(self, keys):
+        """
+        Vectorized find: the slots of an array of keys, -1 for the missing ones. Every probe step is done at once
+        for all the keys still probing.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        slots = np.full(len(keys), -1, dtype=np.intp)
+        # The hash of a whole array, on uint64 which wraps the product modulo 2^64
+        probe = ((keys.astype(np.uint64) * np.uint64(HASH_MULTIPLIER)) >> np.uint64(self.shift)).astype(np.intp)
+        probing = np.arange(len(keys))
+        while len(probing):
+            held = self.keys[probe]
+            found = held == keys[probing]
+            slots[probing[found]] = probe[found]
+            going_on = ~found & (held != EMPTY)
+            probing = probing[going_on]
+            probe = (probe[going_on] + 1) & self.mask
+        hits = slots[slots >= 0]
+        self.stamps[hits] = self.clock + 1 + np.arange(len(hits))
+        self.clock += len(hits)
+        return slots
+
+    def insert_many(self, keys):
+        """
+        Vectorized insertion of an array of distinct keys that are not held, without maintain(): their slots. Each
+        probe round places, for every empty slot claimed, the first key claiming it, and moves the others on.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self.size + len(keys) >= self.capacity:
+            raise MemoryError('Hashed table full: call maintain() between batches of insertions')
+        slots = np.empty(len(keys), dtype=np.intp)
+        probe = ((keys.astype(np.uint64) * np.uint64(HASH_MULTIPLIER)) >> np.uint64(self.shift)).astype(np.intp)
+        probing = np.arange(len(keys))
+        while len(probing):
+            free = self.keys[probe] == EMPTY
+            claimed, first = np.unique(probe[free], return_index=True)
+            placed = probing[np.flatnonzero(free)[first]]
+            self.keys[claimed] = keys[placed]
+            slots[placed] = claimed
+            going_on = np.ones(len(probing), dtype=np.bool_)
+            going_on[np.flatnonzero(free)[first]] = False
+            probing = probing[going_on]
+            probe = (probe[going_on] + 1) & self.mask
+        self.size += len(keys)
+        self.stamps[slots] = self.clock + 1 + np.arange(len(keys))
+        self.clock += len(keys)
+        return slots
+
+    def put_many(self, keys, **values):
+        """
+        Insert or overwrite the entries of an array of distinct keys with the given field values, in chunks small
+        enough for maintain() to make room before each: any number of keys fits, the first ones being evicted if
+        needed.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        chunk = max(self.capacity - int(self.max_load * self.capacity) - 1, 1)
+        for start in range(0, len(keys), chunk):
+            self.maintain()
+            slots = self.find_many(keys[start:start + chunk])
+            missing = slots < 0
+            slots[missing] = self.insert_many(keys[start:start + chunk][missing])
+            for name, field_values in values.items():
+                getattr(self, name)[slots] = np.asarray(field_values)[start:start + chunk]
+
+    def pin(self, key):
+        slot = self.slot(key)
+        self.pinned[slot] = True
+        return slot
+
+    def maintain(self):
+        """
+        Evict the least recently used entries if the table is over its maximal load. Returns whether it did, in
+        which case every slot held before has moved.
+        """
+        if self.size <= self.max_load * self.capacity:
+            return False
+        held = np.flatnonzero(self.keys != EMPTY)
+        evictable = held[~self.pinned[held]]
+        n_evicted = min(self.size - int(self.evict_to * self.capacity), len(evictable))
+        if n_evicted > 0:
+            oldest = evictable[np.argpartition(self.stamps[evictable], n_evicted - 1)[:n_evicted]]
+            self.keys[oldest] = EMPTY
+            self.evictions += n_evicted
+        self.rehash()
+        return True
+
+    def rehash(self):
+        # Reinsert the held entries in a cleared table: linear probing cannot simply leave holes where it evicted
+        held = np.flatnonzero(self.keys != EMPTY)
+        keys = self.keys[held]
+        stamps = self.stamps[held]
+        pinned = self.pinned[held]
+        rows = {name: getattr(self, name)[held] for name, _, _, _ in self.fields}
+        self.keys[:] = EMPTY
+        self.pinned[:] = False
+        for name, _, _, fill in self.fields:
+            getattr(self, name)[:] = fill
+        self.size = 0
+        slots = self.insert_many(keys)
+        self.stamps[slots] = stamps
+        self.pinned[slots] = pinned
+        for name, values in rows.items():
+            getattr(self, name)[slots] = values
+
+    def items(self):
+        # (key, slot) of every held entry
+        held = np.flatnonzero(self.keys != EMPTY)
+        return zip(self.keys[held].tolist(), held.tolist())
+
+    def nbytes(self):
+        return sum(array.nbytes for array in
+                   [self.keys, self.stamps, self.pinned] + [getattr(self, name) for name, _, _, _ in self.fields])
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,118 @@
+"""
+Explicit MDP of the player against the random beast, as scipy.sparse matrices over the states
+s = player_cell * n_cells + beast_cell, cell = x * height + y.
+"""
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+from bellman_cache import solution_key
+from optimal_control import compute_reward, compute_transition_tables, reward_vector
+
+model_cache = OrderedDict()
+MODEL_CACHE_SIZE = 8
+
+
+class MazeMDP:
+    """
+    transitions[i]: CSR (n_states, n_states) matrix of P(s' | s, player_actions[i]); rows of the states where the
+                    action is not allowed are empty
+    feasible[i, s]: whether player_actions[i] is allowed in s
+    step_rewards, final_rewards: reward function evaluated with final=False / final=True in every state
+    absorbing[s]: goal reached or player caught; only 'stay' is allowed and the state loops on itself
+    """
+    def __init__(self, maze, player_actions, beast_actions, reward_function=None, absorbing=True):
+        self.maze = maze
+        self.player_actions = list(player_actions)
+        self.beast_actions = list(beast_actions)
+        self.reward_function = reward_function if reward_function is not None else compute_reward
+        self.n_cells = maze.length * maze.height
+        self.n_states = self.n_cells * self.n_cells
+        player_next, player_feasible, beast_next, beast_weights = \
+            compute_transition_tables(maze, self.player_actions, self.beast_actions)
+
+        n = self.n_cells
+        player_cells = np.repeat(np.arange(n), n)
+        beast_cells = np.tile(np.arange(n), n)
+        goal = maze.cell_id(maze.goal_state.x, maze.goal_state.y)
+        self.absorbing = (player_cells == goal) | (player_cells == beast_cells)
+        if not absorbing:
+            self.absorbing[:] = False
+        self.feasible = player_feasible[:, player_cells]
+        if self.absorbing.any():
+            assert 'stay' in self.player_actions, "The player needs the 'stay' action in absorbing states"
+            self.feasible[:, self.absorbing] = False
+            self.feasible[self.player_actions.index('stay'), self.absorbing] = True
+
+        # Beast moves are shared by all the player actions: the nonzero (state, beast action) pairs
+        states = []
+        beast_moves = []
+        for j in range(len(self.beast_actions)):
+            moves = np.flatnonzero(beast_weights[j, beast_cells] > 0)
+            states.append(moves)
+            beast_moves.append(np.full(len(moves), j))
+        states = np.concatenate(states)
+        beast_moves = np.concatenate(beast_moves)
+        weights = beast_weights[beast_moves, beast_cells[states]]
+        next_beast = beast_next[beast_moves, beast_cells[states]]
+        absorbing_states = np.flatnonzero(self.absorbing)
+
+        self.transitions = []
+        for i in range(len(self.player_actions)):
+            keep = self.feasible[i, states] & ~self.absorbing[states]
+            rows = states[keep]
+            cols = player_next[i, player_cells[rows]] * n + next_beast[keep]
+            data = weights[keep]
+            if self.feasible[i, absorbing_states].any():
+                rows = np.concatenate([rows, absorbing_states])
+                cols = np.concatenate([cols, absorbing_states])
+                data = np.concatenate([data, np.ones(len(absorbing_states))])
+            self.transitions.append(sp.csr_matrix((data, (rows, cols)), shape=(self.n_states, self.n_states)))
+
+        self.step_rewards, self.final_rewards = self.reward_vectors()
+
+    def reward_vectors(self):
+        # The rewards do not depend on t here: they are evaluated at t = 0
+        states = np.arange(self.n_states)
+        return (reward_vector(self.reward_function, self.maze, states, 0, final=False),
+                reward_vector(self.reward_function, self.maze, states, 0, final=True))
+
+    def expected_values(self, values, states=None):
+        """
+        E[V(s') | s, a] for every player action, as a (n_actions, n_states) array (or only for the given slice
+        of states); -inf where the action is not allowed.
+        """
+        values = values.reshape(-1)
+        rows = slice(None) if states is None else states
+        expected = np.empty((len(self.transitions), len(np.arange(self.n_states)[rows])))
+        for i, transitions in enumerate(self.transitions):
+            matrix = transitions if states is None else transitions[rows]
+            expected[i] = matrix @ values
+        expected[~self.feasible[:, rows]] = -np.inf
+        return expected
+
+    def policy_transitions(self, policy):
+        """
+        Transition matrix of the chain followed when the player applies policy[s] (an action index) in each state.
+        """
+        policy = np.asarray(policy).reshape(-1)
+        matrix = sp.csr_matrix((self.n_states, self.n_states))
+        for i, transitions in enumerate(self.transitions):
+            matrix = matrix + sp.diags((policy == i).astype(np.float64)) @ transitions
+        return matrix.tocsr()
+
+
+def build_mdp(maze, player_actions, beast_actions, reward_function=None, absorbing=True):
+    """
+    MazeMDP of the maze, shared with the previous calls on the same geometry, actions and reward values.
+    """
+    reward_function = reward_function if reward_function is not None else compute_reward
+    states = np.arange((maze.length * maze.height) ** 2)
+    rewards = [reward_vector(reward_function, maze, states, 0, final) for final in (False, True)]
+    key = (solution_key(maze, player_actions, beast_actions, rewards), absorbing)
+    if key in model_cache:
+        model_cache.move_to_end(key)
+    else:
+        model_cache[key] = MazeMDP(maze, player_actions, beast_actions, reward_function, absorbing)
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+    return model_cache[key]
@@ -1,11 +1,11 @@
 import numpy as np
-import copy
 from abc import ABCMeta, abstractmethod
 import random
 
-def cprint(cstring):
-    cstring = '{0: <3}'.format(cstring)
-    print(cstring.format(), end="", flush=True)
+# Integer codes of the moves shared by every agent, and the (dx, dy) they apply to a MazeState
+ACTIONS = ['stay', 'up', 'down', 'left', 'right']
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+ACTION_DELTAS = ((0, 0), (0, -1), (0, 1), (-1, 0), (1, 0))
 
 
 class MazeAgent:
@@ -25,16 +25,17 @@ class MazeAgent:
 
 
 class MazePlayer(MazeAgent):
-    def choose_action(self, beast_state, time_step, action):
-        x_p = self.state.x
-        y_p = self.state.y
-        x_b = beast_state.x
-        y_b = beast_state.y
+    def choose_action(self, beast_state, time_step, action=None):
+        # An explicit action overrides the policy. beast_state can also be a list of states, one per pursuer, for
+        # the policies of multi_pursuit.LazyBellmansOptimizer
         if action is not None:
-            policy = self.policies[(x_p, y_p, x_b, y_b)]
-            return policy[-(time_step+1)][0]
-        else:
             return action
+        if isinstance(beast_state, MazeState):
+            key = (self.state.x, self.state.y, beast_state.x, beast_state.y)
+        else:
+            key = (self.state.x, self.state.y) + tuple(c for state in beast_state for c in (state.x, state.y))
+        policy = self.policies[key]
+        return policy[-(time_step+1)][0]
 
     def collect_reward(self):
         pass
@@ -70,6 +71,7 @@ class Maze:
         self.horiz_walls = []
         self.outer_horiz_walls = []
         self.outer_vert_walls = []
+        self._tables = None
 
         self.add_vert_wall(-1, 0, height-1, outer=True)
         self.add_vert_wall(length-1, 0, height-1, outer=True)
@@ -82,13 +84,36 @@ class Maze:
         self.vert_walls.append({'x': x, 'y_min': y_min, 'y_max': y_max})
         if outer:
             self.outer_vert_walls.append({'x': x, 'y_min': y_min, 'y_max': y_max})
+        self._tables = None
 
     def add_horiz_wall(self, y, x_min, x_max, outer = False):
         self.horiz_walls.append({'y': y, 'x_min': x_min, 'x_max': x_max})
         if outer:
             self.outer_horiz_walls.append({'y': y, 'x_min': x_min, 'x_max': x_max})
+        self._tables = None
+
+    def tables(self):
+        # Compiled lazily, and again after any wall is added
+        if self._tables is None:
+            self._tables = MazeTables(self)
+        return self._tables
+
+    def cell_id(self, x, y):
+        return x * self.height + y
 
     def check_player_action(self, action, state):
+        code = ACTION_CODES.get(action)
+        if code is None or not (0 <= state.x < self.length and 0 <= state.y < self.height):
+            return self.scan_player_action(action, state)
+        return self.tables().player_mask_list[state.x * self.height + state.y] >> code & 1 == 1
+
+    def check_beast_action(self, action, state):
+        code = ACTION_CODES.get(action)
+        if code is None or not (0 <= state.x < self.length and 0 <= state.y < self.height):
+            return self.scan_beast_action(action, state)
+        return self.tables().beast_mask_list[state.x * self.height + state.y] >> code & 1 == 1
+
+    def scan_player_action(self, action, state):
         if action == 'stay':
             return True
 
@@ -116,7 +141,7 @@ class Maze:
                     return False
             return True
 
-    def check_beast_action(self, action, state):
+    def scan_beast_action(self, action, state):
         if action == 'stay':
             return True
 
@@ -145,7 +170,6 @@ class Maze:
             return True
 
     def compute_feasible_player_future_states(self, allowed_actions, player_state):
-        # TODO: adjust in the init
         feasible_actions = []
         for action in allowed_actions:
             if self.check_player_action(action, player_state):
@@ -153,7 +177,6 @@ class Maze:
         return feasible_actions
 
     def compute_feasible_beast_future_states(self, allowed_actions, beast_state):
-        # TODO: adjust in the init
         feasible_actions = []
         for action in allowed_actions:
             if self.check_beast_action(action, beast_state):
@@ -161,79 +184,244 @@ class Maze:
         return feasible_actions
 
 
+class MazeTables:
+    """
+    Walls of a maze compiled into per-cell lookups. Cells are indexed by x * height + y and actions by ACTION_CODES:
+        player_masks[c], beast_masks[c]: bit k is set when action k is allowed from c
+        player_next[k, c], beast_next[k, c]: cell reached from c with action k (c itself when not allowed)
+    """
+    def __init__(self, maze):
+        n_cells = maze.length * maze.height
+        self.player_masks = np.zeros(n_cells, dtype=np.uint8)
+        self.beast_masks = np.zeros(n_cells, dtype=np.uint8)
+        self.player_next = np.tile(np.arange(n_cells), (len(ACTIONS), 1))
+        self.beast_next = np.tile(np.arange(n_cells), (len(ACTIONS), 1))
+        for x in range(maze.length):
+            for y in range(maze.height):
+                c = maze.cell_id(x, y)
+                state = MazeState(x, y)
+                for code, action in enumerate(ACTIONS):
+                    dx, dy = ACTION_DELTAS[code]
+                    if maze.scan_player_action(action, state):
+                        self.player_masks[c] |= 1 << code
+                        self.player_next[code, c] = maze.cell_id(x + dx, y + dy)
+                    if maze.scan_beast_action(action, state):
+                        self.beast_masks[c] |= 1 << code
+                        self.beast_next[code, c] = maze.cell_id(x + dx, y + dy)
+        # Plain lists are faster than numpy scalars for the one-off checks of check_*_action
+        self.player_mask_list = self.player_masks.tolist()
+        self.beast_mask_list = self.beast_masks.tolist()
+
+    @staticmethod
+    def feasible(masks, codes):
+        # (len(codes), n_cells) boolean table of the allowed actions
+        return (masks[None, :] >> np.asarray(codes, dtype=np.uint8)[:, None]) & 1 == 1
+
+
 class MazeState:
+    """
+    Position of an agent. The hot loops work on integer cells (Maze.cell_id) and action codes (ACTION_CODES);
+    MazeState is the thin object API on top of them.
+    """
+    __slots__ = ('x', 'y')
+
     def __init__(self, x_0, y_0):
         self.x = x_0
         self.y = y_0
 
     def update(self, action):
-        if action == 'stay':
-            pass
+        code = ACTION_CODES.get(action)
+        if code is not None:
+            dx, dy = ACTION_DELTAS[code]
+            self.x += dx
+            self.y += dy
 
-        if action == 'down':
-            self.y += 1
+    def copy(self):
+        return MazeState(self.x, self.y)
 
-        if action == 'up':
-            self.y -= 1
 
-        if action == 'right':
-            self.x += 1
-
-        if action == 'left':
-            self.x -= 1
+class ActionSampler:
+    """
+    Uniform draws among the feasible actions of an agent in its cell, read from the compiled maze tables instead of
+    drawing until check_*_action accepts: a step costs one draw whatever the walls around. The uniform numbers
+    come from a numpy Generator in blocks of block_size; getstate/setstate replay the same draws.
+    """
+    def __init__(self, rng=None, block_size=4096):
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.block_size = block_size
+        self.choices = {}
+        self.refill()
+
+    def refill(self):
+        self.block_state = self.rng.bit_generator.state
+        # Plain floats are faster to read one by one than numpy scalars
+        self.block = self.rng.random(self.block_size).tolist()
+        self.position = 0
+
+    def feasible_actions(self, maze, actions, walls='beast'):
+        """
+        For every cell, the list of the actions allowed by the player or the beast walls, in the order of actions.
+        """
+        tables = maze.tables()
+        key = (tuple(actions), walls)
+        entry = self.choices.get(key)
+        if entry is None or entry[0] is not tables:
+            masks = tables.player_masks if walls == 'player' else tables.beast_masks
+            feasible = tables.feasible(masks, [ACTION_CODES[action] for action in actions]).T.tolist()
+            entry = self.choices[key] = (tables, [[action for action, allowed in zip(actions, cell) if allowed]
+                                                  for cell in feasible])
+        return entry[1]
+
+    def choose(self, choices):
+        if self.position == self.block_size:
+            self.refill()
+        u = self.block[self.position]
+        self.position += 1
+        return choices[int(u * len(choices))]
+
+    def sample(self, maze, actions, state, walls='beast'):
+        return self.choose(self.feasible_actions(maze, actions, walls)[state.x * maze.height + state.y])
+
+    def getstate(self):
+        # The generator state at the start of the current block, and the position in it
+        return {'block_state': self.block_state, 'position': self.position}
+
+    def setstate(self, state):
+        self.rng.bit_generator.state = state['block_state']
+        self.refill()
+        self.position = state['position']
 
 
 class QMazeSimulation():
-    def __init__(self,  maze, player=None, beast=None):
+    def __init__(self,  maze, player=None, beast=None, rng=None):
         self.player = player
         self.beast = beast
         self.maze = maze
         self.simulation_time = 0
-
-    def get_player_action(self, action=None):
-        if action is None:
-            action = self.player.choose_action()
-        return action
-
-    def get_beast_action(self, action=None):
-        if action is None:
-            action = self.beast.choose_action()
-        return action
+        self.sampler = ActionSampler(rng)
 
     def step_simulation(self):
         assert self.player is not None,  "You have to initialize the player in the simulations. No simulation possible"
         assert self.beast is not None,  "You have to initialize the police in the simulations. No simulation possible"
 
-        player_action_feasible = False
-        while not player_action_feasible:
-                p_action = self.get_player_action()
-                player_action_feasible = self.maze.check_beast_action(action=p_action, state=self.player.state)
-
-        beast_action_feasible = False
-        while not beast_action_feasible:
-            b_action = self.get_beast_action()
-            beast_action_feasible = self.maze.check_beast_action(action=b_action, state=self.beast.state)
+        # Both agents move at random among their feasible actions; the player is only blocked by the outer walls
+        p_action = self.sampler.sample(self.maze, self.player.possible_actions, self.player.state)
+        b_action = self.sampler.sample(self.maze, self.beast.possible_actions, self.beast.state)
 
         self.player.update_state(p_action)
         self.beast.update_state(b_action)
         self.simulation_time += 1
         return p_action, b_action
 
+    def encode_state(self):
+        n_cells = self.maze.length * self.maze.height
+        return (self.maze.cell_id(self.player.state.x, self.player.state.y) * n_cells +
+                self.maze.cell_id(self.beast.state.x, self.beast.state.y))
+
+    def experience(self, player_actions, reward_function, num_steps=None):
+        """
+        Generator of the transitions (s, a, r, s') of the simulation as plain integers: s = player_cell * n_cells +
+        beast_cell, a the index of the player action in player_actions, r = reward_function(player_state,
+        police_state, goal_state) in s. Runs forever when num_steps is None.
+        """
+        action_index = {action: i for i, action in enumerate(player_actions)}
+        goal_state = self.maze.goal_state
+        state = self.encode_state()
+        step = 0
+        while num_steps is None or step < num_steps:
+            reward = reward_function(player_state=self.player.state, police_state=self.beast.state,
+                                     goal_state=goal_state)
+            p_action, _ = self.step_simulation()
+            next_state = self.encode_state()
+            yield state, action_index[p_action], reward, next_state
+            state = next_state
+            step += 1
+
+
+class BatchedQMazeSimulation():
+    """
+    num_envs independent copies of QMazeSimulation stepped together. Positions are kept as arrays of cell ids
+    (x * height + y) and both agents move uniformly at random among their feasible actions.
+    """
+    def __init__(self, maze, player_actions, beast_actions, num_envs, rng=None):
+        self.maze = maze
+        self.player_actions = list(player_actions)
+        self.beast_actions = list(beast_actions)
+        self.num_envs = num_envs
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.simulation_time = 0
+        tables = maze.tables()
+        player_codes = [ACTION_CODES[action] for action in self.player_actions]
+        beast_codes = [ACTION_CODES[action] for action in self.beast_actions]
+        # As in QMazeSimulation the player is only blocked by the outer walls
+        self.player_feasible = tables.feasible(tables.beast_masks, player_codes).T
+        self.beast_feasible = tables.feasible(tables.beast_masks, beast_codes).T
+        self.player_next = tables.beast_next[player_codes]
+        self.beast_next = tables.beast_next[beast_codes]
+        self.player_cells = np.zeros(num_envs, dtype=np.intp)
+        self.beast_cells = np.zeros(num_envs, dtype=np.intp)
+
+    def reset(self, player_state, beast_state):
+        self.player_cells[:] = self.maze.cell_id(player_state.x, player_state.y)
+        self.beast_cells[:] = self.maze.cell_id(beast_state.x, beast_state.y)
+        self.simulation_time = 0
+
+    def sample_actions(self, feasible):
+        # Uniform draw among the True entries of each row of the (num_envs, n_actions) feasibility table
+        cumulative = np.cumsum(feasible, axis=1)
+        draw = (self.rng.random(len(feasible)) * cumulative[:, -1]).astype(cumulative.dtype)
+        return np.argmax(cumulative > draw[:, None], axis=1)
+
+    def step_simulation(self):
+        p_actions = self.sample_actions(self.player_feasible[self.player_cells])
+        b_actions = self.sample_actions(self.beast_feasible[self.beast_cells])
+        self.player_cells = self.player_next[p_actions, self.player_cells]
+        self.beast_cells = self.beast_next[b_actions, self.beast_cells]
+        self.simulation_time += 1
+        return p_actions, b_actions
+
+
+class BoardRenderer:
+    """
+    Frames of MazeGame.plot_game as single strings: the empty rows of the board are built once, and a frame only
+    rewrites the rows holding the player (P) and the beast (B), or both (O) when they share a cell.
+    """
+    def __init__(self, length, height):
+        self.rows = ['\n' + '{0: <3}{1: <3}'.format(' ', '|') * length] * height
+
+    @staticmethod
+    def mark(row, x, symbol):
+        # Each cell is 6 characters wide, after the newline starting the row
+        i = 1 + 6 * x
+        return row[:i] + symbol + row[i + 1:]
+
+    def frame(self, t, x_p, y_p, x_b, y_b):
+        rows = list(self.rows)
+        if x_p == x_b and y_p == y_b:
+            rows[y_p] = self.mark(rows[y_p], x_p, 'O')
+        else:
+            rows[y_p] = self.mark(rows[y_p], x_p, 'P')
+            rows[y_b] = self.mark(rows[y_b], x_b, 'B')
+        return 'Map at step: ' + str(t) + '\n' + ''.join(rows) + '\n'
+
 
 class MazeGame():
-    def __init__(self, player, beast, maze):
+    def __init__(self, player, beast, maze, rng=None, recorder=None):
         self.player = player
         self.beast = beast
         self.maze = maze
         self.sim_time = 0
+        self.sampler = ActionSampler(rng)
+        self.renderer = BoardRenderer(maze.length, maze.height)
+        # An optional trajectories.TrajectoryRecorder, which gets every step of the game
+        self.recorder = recorder
+        if recorder is not None:
+            self.game_id = recorder.start_game(player.state, beast.state)
 
     def step_simulation(self):
 
         p_action = self.player.choose_action(time_step=self.sim_time, beast_state=self.beast.state)
-        beast_action_feasible = False
-        while not beast_action_feasible:
-            b_action = self.beast.choose_action()
-            beast_action_feasible = self.maze.check_beast_action(action=b_action, state=self.beast.state)
+        b_action = self.sampler.sample(self.maze, self.beast.possible_actions, self.beast.state)
         if self.player.state.x == self.beast.state.x and self.player.state.y == self.beast.state.y:
             b_action = 'stay'
             p_action = 'stay'
@@ -241,26 +429,12 @@ class MazeGame():
         self.player.update_state(p_action)
         self.beast.update_state(b_action)
         self.sim_time += 1
+        if self.recorder is not None:
+            self.recorder.record(self.game_id, self.sim_time, self.player.state, self.beast.state, p_action, b_action)
+
+    def render(self):
+        return self.renderer.frame(self.sim_time, self.player.state.x, self.player.state.y,
+                                   self.beast.state.x, self.beast.state.y)
 
     def plot_game(self):
-        print('Map at step: '+str(self.sim_time))
-        x_p = self.player.state.x
-        y_p = self.player.state.y
-        x_b = self.beast.state.x
-        y_b = self.beast.state.y
-
-        for y in range(self.maze.height):
-            print()
-            for x in range(self.maze.length):
-                if x_p == x_b and y_p == y_b:
-                    if x_p == x and y_p == y:
-                        cprint('O')
-                else:
-                    if x_p == x and y_p == y:
-                        cprint('P')
-                    elif x_b == x and y_b == y:
-                        cprint('B')
-                    else:
-                        cprint(' ')
-                cprint('|')
-        print()
+        print(self.render(), end='', flush=True)
@@ -0,0 +1,359 @@
+"""
+Pursuit of the player by k beasts. The joint state (x_p, y_p, x_b1, y_b1, ..., x_bk, y_bk) is encoded as
+((player_cell * n_cells + beast_cell_1) * n_cells + ...) * n_cells + beast_cell_k, the encoding of QTable when
+k = 1. Dense tables would have n_cells^(k+1) rows: here the values and Q values live in lazy_store.HashedTable
+stores of fixed capacity, and are only computed for the states that are queried or visited.
+"""
+import itertools
+import numpy as np
+from collections.abc import Mapping
+from tqdm import tqdm
+from lazy_store import HashedTable
+from maze_utilities import ActionSampler, ACTION_CODES
+from optimal_control import StatePolicy, compute_transition_tables, reward_vector
+from Q_learning import QLearning
+from instrumentation import RingBuffer
+
+
+def pursuit_reward(t, maze, beast_states, player_state, action, final):
+    # compute_reward with k beasts: 100 for ending the game on the goal
+    if player_state.x == maze.goal_state.x and player_state.y == maze.goal_state.y and final:
+        return 100
+    return 0
+
+
+class JointStates:
+    """
+    Encoding of the joint states of the player and n_pursuers beasts, one by one or on arrays.
+    """
+    def __init__(self, maze, n_pursuers):
+        assert n_pursuers >= 1, "At least one pursuer is needed"
+        self.length = maze.length
+        self.height = maze.height
+        self.n_cells = maze.length * maze.height
+        self.n_pursuers = n_pursuers
+        self.n_states = self.n_cells ** (n_pursuers + 1)
+
+    def encode_cells(self, player_cell, beast_cells):
+        s = player_cell
+        for cell in beast_cells:
+            s = s * self.n_cells + cell
+        return s
+
+    def decode_cells(self, s):
+        beast_cells = []
+        for _ in range(self.n_pursuers):
+            s, cell = divmod(s, self.n_cells)
+            beast_cells.append(cell)
+        return s, beast_cells[::-1]
+
+    def encode(self, player_state, beast_states):
+        return self.encode_cells(player_state.x * self.height + player_state.y,
+                                 [state.x * self.height + state.y for state in beast_states])
+
+    def encode_key(self, key):
+        # (x_p, y_p, x_b1, y_b1, ...) -> s
+        if len(key) != 2 * (self.n_pursuers + 1) or not all(
+                0 <= x < self.length and 0 <= y < self.height for x, y in zip(key[::2], key[1::2])):
+            raise KeyError(key)
+        cells = [x * self.height + y for x, y in zip(key[::2], key[1::2])]
+        return self.encode_cells(cells[0], cells[1:])
+
+    def decode(self, s):
+        player_cell, beast_cells = self.decode_cells(s)
+        return tuple(c for cell in [player_cell] + beast_cells for c in divmod(cell, self.height))
+
+    def split(self, states):
+        # Player cells and (n_pursuers, len(states)) beast cells of an array of encoded states
+        states = np.asarray(states, dtype=np.int64)
+        beast_cells = np.empty((self.n_pursuers, len(states)), dtype=np.int64)
+        for j in range(self.n_pursuers - 1, -1, -1):
+            states, beast_cells[j] = np.divmod(states, self.n_cells)
+        return states, beast_cells
+
+    def join(self, player_cells, beast_cells):
+        states = np.asarray(player_cells, dtype=np.int64)
+        for cells in beast_cells:
+            states = states * self.n_cells + cells
+        return states
+
+
+class LazyBellmansOptimizer:
+    """
+    Finite horizon problem of BellmansOptimizer against n_pursuers beasts, each moving uniformly among its
+    feasible moves, independently of the others. Reaching the goal or sharing a cell with any beast is absorbing.
+    Nothing is solved upfront: values(t, states) expands the states reachable from states in T - t steps, level by
+    level, stopping at the ones already solved, and computes the missing ones backward on arrays. The solved
+    (t, state) entries are memoized in a HashedTable of capacity entries. A query holds its levels, at most capacity
+    entries over all of them, and refuses with MemoryError to need more rather than solving evicted states again;
+    the successors and the backups are computed chunk_size states at a time, with at most chunk_size *
+    len(player_actions) * len(beast_actions)^n_pursuers successors in flight, capacity by default. For one pursuer,
+    the values and actions are bit-identical to the ones of solve_bellman_numpy.
+    reward_function(t, maze, beast_states, player_state, action, final) gets the list of the beast states.
+    """
+    def __init__(self, maze, player_actions, beast_actions, n_pursuers, T=15, reward_function=None, capacity=2**20,
+                 chunk_size=None):
+        assert 'stay' in player_actions, "The player needs the 'stay' action to rest in absorbing states"
+        self.maze = maze
+        self.player_actions = player_actions
+        self.beast_actions = beast_actions
+        self.T = T
+        self.joint = JointStates(maze, n_pursuers)
+        assert (T + 1) * self.joint.n_states < 2 ** 63, "The (t, state) keys do not fit in int64"
+        self.reward_function = reward_function if reward_function is not None else pursuit_reward
+        self.stay = player_actions.index('stay')
+        self.player_next, self.player_feasible, self.beast_next, self.beast_weights = \
+            compute_transition_tables(maze, player_actions, beast_actions)
+        # Joint moves of the beasts: one move index per beast, in lexicographic order
+        self.beast_moves = list(itertools.product(range(len(beast_actions)), repeat=n_pursuers))
+        self.goal = maze.cell_id(maze.goal_state.x, maze.goal_state.y)
+        self.store = HashedTable(capacity, [('value', np.float64, (), np.nan), ('action', np.uint8, (), 0)])
+        if chunk_size is None:
+            chunk_size = max(capacity // (len(player_actions) * len(self.beast_moves)), 1)
+        self.chunk_size = chunk_size
+
+    def rewards(self, states, final):
+        return reward_vector(self.reward_function, self.maze, states, self.T, final, self.joint.n_pursuers)
+
+    def absorbing(self, player_cells, beast_cells):
+        return (player_cells == self.goal) | (beast_cells == player_cells[None, :]).any(axis=0)
+
+    def next_states(self, player_cells, beast_cells):
+        """
+        Generator of (i, weights, states): for player action i and each joint move of the beasts, its probability
+        and the states reached, whether the action is feasible or not.
+        """
+        for i in range(len(self.player_actions)):
+            next_player = self.player_next[i][player_cells]
+            for move in self.beast_moves:
+                weights = self.beast_weights[move[0]][beast_cells[0]]
+                for j in range(1, len(move)):
+                    weights = weights * self.beast_weights[move[j]][beast_cells[j]]
+                next_beasts = [self.beast_next[m][cells] for m, cells in zip(move, beast_cells)]
+                yield i, weights, self.joint.join(next_player, next_beasts)
+
+    def successors(self, states):
+        # Distinct states reached in one step, expanded chunk_size states at a time
+        successors = np.zeros(0, dtype=np.int64)
+        for start in range(0, len(states), self.chunk_size):
+            chunk = states[start:start + self.chunk_size]
+            player_cells, beast_cells = self.joint.split(chunk)
+            absorbing = self.absorbing(player_cells, beast_cells)
+            reached = [successors, chunk[absorbing]]
+            transient = ~absorbing
+            player_cells, beast_cells = player_cells[transient], beast_cells[:, transient]
+            reached.extend(next_states for _, _, next_states in self.next_states(player_cells, beast_cells))
+            successors = np.unique(np.concatenate(reached))
+        return successors
+
+    def backward_step(self, states, next_states, next_values):
+        """
+        Values and actions of the step t states from the sorted step t+1 states next_states and their values, as
+        bellman_backward_step computes them.
+        """
+        player_cells, beast_cells = self.joint.split(states)
+        r_step = self.rewards(states, final=False)
+        absorbing = self.absorbing(player_cells, beast_cells)
+        transient = ~absorbing
+        q = np.full((len(self.player_actions), len(states)), -1000.0)
+        u_t = np.zeros((len(self.player_actions), int(transient.sum())))
+        for i, weights, reached in self.next_states(player_cells[transient], beast_cells[:, transient]):
+            u_t[i] += weights * next_values[np.searchsorted(next_states, reached)]
+        for i in range(len(self.player_actions)):
+            u_t[i] += r_step[transient]
+            q[i, transient] = np.where(self.player_feasible[i][player_cells[transient]], u_t[i], -1000)
+        # In absorbing states only 'stay' is allowed and the beasts do not move anymore
+        stay_values = next_values[np.searchsorted(next_states, states[absorbing])]
+        q[self.stay, absorbing] = stay_values + r_step[absorbing]
+        actions = np.argmax(q, axis=0)
+        return np.take_along_axis(q, actions[None], axis=0)[0], actions.astype(np.uint8)
+
+    def values(self, t, states):
+        """
+        Values and action indices of an array of encoded states at step t. Raises MemoryError when the states of
+        the steps it expands hold more than capacity entries.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        n_states = self.joint.n_states
+        # Forward: the states of each step that are needed, with the values found in the store
+        levels = []
+        frontier = np.unique(states)
+        n_entries = 0
+        for u in range(t, self.T + 1):
+            n_entries += len(frontier)
+            if n_entries > self.store.capacity:
+                raise MemoryError('The states reached from step ' + str(t) + ' do not fit in ' +
+                                  str(self.store.capacity) + ' entries: raise the capacity or shorten the horizon')
+            slots = self.store.find_many(u * n_states + frontier)
+            held = slots >= 0
+            values = np.where(held, self.store.value[slots], np.nan)
+            actions = np.where(held, self.store.action[slots], 0).astype(np.uint8)
+            levels.append((frontier, held, values, actions))
+            if held.all() or u == self.T:
+                break
+            frontier = self.successors(frontier[~held])
+        # Backward: solve the missing ones, each step from the next one, chunk_size states at a time
+        for k in range(len(levels) - 1, -1, -1):
+            frontier, held, values, actions = levels[k]
+            missing = np.flatnonzero(~held)
+            if not len(missing):
+                continue
+            if t + k == self.T:
+                values[missing] = self.rewards(frontier[missing], final=True)
+                actions[missing] = self.stay
+            else:
+                next_states, _, next_values, _ = levels[k + 1]
+                for start in range(0, len(missing), self.chunk_size):
+                    chunk = missing[start:start + self.chunk_size]
+                    values[chunk], actions[chunk] = self.backward_step(frontier[chunk], next_states, next_values)
+                levels[k + 1] = None
+            self.store.put_many((t + k) * n_states + frontier[missing], value=values[missing],
+                                action=actions[missing])
+        frontier, _, values, actions = levels[0]
+        index = np.searchsorted(frontier, states)
+        return values[index], actions[index]
+
+    def value(self, t, player_state, beast_states):
+        values, _ = self.values(t, [self.joint.encode(player_state, beast_states)])
+        return float(values[0])
+
+    def policies(self):
+        return LazyPolicies(self)
+
+
+class LazyPolicies(Mapping):
+    """
+    MazePlayer.policies of a LazyBellmansOptimizer, solved on access:
+    policies[(x_p, y_p, x_b1, y_b1, ...)][-(t+1)] -> (action, value)
+    """
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self.player_actions = optimizer.player_actions
+
+    def __getitem__(self, state):
+        return LazyStatePolicy(self, self.optimizer.joint.encode_key(state))
+
+    def __iter__(self):
+        return (self.optimizer.joint.decode(s) for s in range(self.optimizer.joint.n_states))
+
+    def __len__(self):
+        return self.optimizer.joint.n_states
+
+
+class LazyStatePolicy(StatePolicy):
+    def entry(self, t):
+        values, actions = self.policies.optimizer.values(t, [self.state])
+        return self.policies.player_actions[actions[0]], float(values[0])
+
+    def __len__(self):
+        return self.policies.optimizer.T + 1
+
+
+class MultiPursuitSimulation:
+    """
+    QMazeSimulation with a list of beasts: the player and every beast move at random among their feasible actions.
+    """
+    def __init__(self, maze, player=None, beasts=None, rng=None):
+        self.player = player
+        self.beasts = beasts
+        self.maze = maze
+        self.simulation_time = 0
+        self.sampler = ActionSampler(rng)
+
+    def step_simulation(self):
+        assert self.player is not None and self.beasts, "The player and the beasts have to be set"
+        p_action = self.sampler.sample(self.maze, self.player.possible_actions, self.player.state)
+        b_actions = [self.sampler.sample(self.maze, beast.possible_actions, beast.state) for beast in self.beasts]
+        self.player.update_state(p_action)
+        for beast, b_action in zip(self.beasts, b_actions):
+            beast.update_state(b_action)
+        self.simulation_time += 1
+        return p_action, b_actions
+
+
+class LazyQLearning:
+    """
+    QLearning of a MultiPursuitSimulation, with the updates of QLearning.update_q on a Q function allocated lazily:
+    a HashedTable of capacity entries holds the Q values and update counts of the visited states only, and evicts
+    the least recently visited ones when it fills up. An evicted state starts over from init_value if it is
+    visited again. The initial state is pinned, for its Q value history.
+    """
+    def __init__(self, simulation_environment, num_iterations, lmb, player_possible_actions, police_possible_actions,
+                 capacity=2**20, init_value=0.1, history_every=1):
+        self.simulation_environment = simulation_environment
+        self.num_iterations = num_iterations
+        self.lmb = lmb
+        self.player_possible_actions = player_possible_actions
+        self.police_possible_actions = police_possible_actions
+        maze = simulation_environment.maze
+        self.joint = JointStates(maze, len(simulation_environment.beasts))
+        self.action_index = {action: i for i, action in enumerate(player_possible_actions)}
+        n_actions = len(player_possible_actions)
+        self.store = HashedTable(capacity, [('q', np.float64, (n_actions,), init_value),
+                                            ('n', np.int32, (n_actions,), 0)])
+        tables = maze.tables()
+        codes = [ACTION_CODES[action] for action in player_possible_actions]
+        self.player_feasible = tables.feasible(tables.player_masks, codes).T
+        self.init_value = init_value
+        # Encoded states divided by player_divisor give the player cell
+        self.player_divisor = self.joint.n_cells ** self.joint.n_pursuers
+        self.initial_state = self.encode_state()
+        self.store.pin(self.initial_state)
+        self.initial_state_actions = np.flatnonzero(self.player_feasible[self.initial_state // self.player_divisor])
+        self.history_every = history_every
+        self.q_initial_state_history = RingBuffer(-(-num_iterations // history_every))
+        self.td_error = 0.0
+        self.iteration = 0
+
+    @staticmethod
+    def reward_function(player_state, police_states, goal_state):
+        # QLearning.reward_function, caught by any of the beasts
+        for police_state in police_states:
+            if player_state.x == police_state.x and player_state.y == police_state.y:
+                return -10
+        if player_state.x == goal_state.x and player_state.y == goal_state.y:
+            return 1
+        return 0
+
+    def encode_state(self):
+        simulation = self.simulation_environment
+        return self.joint.encode(simulation.player.state, [beast.state for beast in simulation.beasts])
+
+    def simulate_and_learn(self):
+        simulation = self.simulation_environment
+        goal_state = simulation.maze.goal_state
+        state = self.encode_state()
+        for i in tqdm(range(self.iteration, self.num_iterations), initial=self.iteration, total=self.num_iterations):
+            reward = self.reward_function(simulation.player.state, [beast.state for beast in simulation.beasts],
+                                          goal_state)
+            p_action, _ = simulation.step_simulation()
+            next_state = self.encode_state()
+            q_initial_state_t = self.update_q(state, self.action_index[p_action], reward, next_state)
+            state = next_state
+            if i % self.history_every == 0:
+                self.q_initial_state_history.append(q_initial_state_t)
+            self.iteration = i + 1
+
+    def update_q(self, s, a, reward, s_next):
+        store = self.store
+        # Make room first: the slots below stay valid until the next maintain
+        store.maintain()
+        row = store.slot(s)
+        next_row = store.slot(s_next)
+        q = store.q
+        n = store.n
+        max_future_q = q[next_row][self.player_feasible[s_next // self.player_divisor]].max()
+        n[row, a] += 1
+        self.td_error = reward + self.lmb * max_future_q - q[row, a]
+        q[row, a] += QLearning.step_size(int(n[row, a])) * self.td_error
+        return self.q_initial_state()
+
+    def q_initial_state(self):
+        return float(self.store.q[self.store.find(self.initial_state), self.initial_state_actions].max())
+
+    def q_values(self, player_state, beast_states):
+        # Q values of every action in a state, the initial ones if it is not held
+        slot = self.store.find(self.joint.encode(player_state, beast_states))
+        if slot < 0:
+            return np.full(len(self.player_possible_actions), self.init_value)
+        return self.store.q[slot].copy()
@@ -0,0 +1,107 @@
+"""
+Multi-step update rules for QLearning.simulate_and_learn: n-step Q-learning and Watkins Q(lambda). The exploration
+of QLearning is uniformly random, so both are off-policy: a return only follows the actions that were greedy,
+and is cut at the first exploratory one, where it bootstraps on max Q.
+"""
+from collections import deque
+
+
+def is_greedy(q_learning, row, s, a):
+    # Whether a is a best feasible action of the encoded state s (of row row in the Q table)
+    q = q_learning.q_table.q[row]
+    return q[a] >= q[q_learning.player_feasible[s // q_learning.q_table.n_cells]].max()
+
+
+def max_future_q(q_learning, s):
+    q = q_learning.q_table.q[q_learning.q_table.state_row(s)]
+    return q[q_learning.player_feasible[s // q_learning.q_table.n_cells]].max()
+
+
+class NStepQ:
+    """
+    Each (s, a) is updated towards r_0 + lmb r_1 + ... + lmb^(m-1) r_(m-1) + lmb^m max Q(s_m), with m = n unless
+    an exploratory action is taken before: then the pending transitions bootstrap on the state it was taken in.
+    The step size is QLearning.step_size of the update count, as for the one-step updates.
+    """
+    def __init__(self, n=4):
+        assert n >= 1, "n-step returns need n >= 1"
+        self.n = n
+        self.pending = deque()
+
+    def reset(self):
+        self.pending.clear()
+
+    def backup(self, q_learning, bootstrap):
+        # Update the oldest pending transition with the rewards after it and the bootstrap value
+        q = q_learning.q_table.q
+        n = q_learning.q_table.n
+        row, a, _ = self.pending[0]
+        target = bootstrap
+        for _, _, reward in reversed(self.pending):
+            target = reward + q_learning.lmb * target
+        n[row, a] += 1
+        q_learning.td_error = target - q[row, a]
+        q[row, a] += q_learning.step_size(int(n[row, a])) * q_learning.td_error
+        self.pending.popleft()
+
+    def update(self, q_learning, s, a, reward, s_next):
+        row = q_learning.q_table.state_row(s)
+        if self.pending and not is_greedy(q_learning, row, s, a):
+            # Cut the returns: every pending transition bootstraps on s
+            bootstrap = max_future_q(q_learning, s)
+            while self.pending:
+                self.backup(q_learning, bootstrap)
+        self.pending.append((row, a, reward))
+        if len(self.pending) == self.n:
+            self.backup(q_learning, max_future_q(q_learning, s_next))
+        return q_learning.q_initial_state()
+
+
+class WatkinsQLambda:
+    """
+    Watkins Q(lambda) with replacing traces: every step, the TD error of the transition updates every (s, a) of the
+    trace in proportion of its eligibility, which decays by lmb * trace_decay per step and is reset by an
+    exploratory action. Eligibilities below threshold are dropped, so the trace never holds more than
+    log(threshold) / log(lmb * trace_decay) + 1 pairs and a step has a bounded cost. The trace is a few short
+    parallel lists: with so few entries, plain Python beats numpy calls.
+    """
+    def __init__(self, trace_decay=0.9, threshold=1e-3):
+        self.trace_decay = trace_decay
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.rows = []
+        self.actions = []
+        self.eligibility = []
+
+    def update(self, q_learning, s, a, reward, s_next):
+        q = q_learning.q_table.q
+        n = q_learning.q_table.n
+        row = q_learning.q_table.state_row(s)
+        if not is_greedy(q_learning, row, s, a):
+            self.reset()
+        # Replacing trace: (s, a) gets eligibility 1, in place if it is already in the trace
+        for k in range(len(self.rows)):
+            if self.rows[k] == row and self.actions[k] == a:
+                self.eligibility[k] = 1.0
+                break
+        else:
+            self.rows.append(row)
+            self.actions.append(a)
+            self.eligibility.append(1.0)
+        n[row, a] += 1
+
+        q_learning.td_error = td_error = reward + q_learning.lmb * max_future_q(q_learning, s_next) - q[row, a]
+        decay = q_learning.lmb * self.trace_decay
+        rows, actions, eligibility = [], [], []
+        for r, b, e in zip(self.rows, self.actions, self.eligibility):
+            q[r, b] += q_learning.step_size(int(n[r, b])) * td_error * e
+            # Decay, and keep only the eligibilities above threshold
+            e *= decay
+            if e >= self.threshold:
+                rows.append(r)
+                actions.append(b)
+                eligibility.append(e)
+        self.rows, self.actions, self.eligibility = rows, actions, eligibility
+        return q_learning.q_initial_state()
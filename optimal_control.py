@@ -1,107 +1,545 @@
 from maze_utilities import *
-import copy
+import checkpoint
+from trajectories import TrajectoryRecorder, replay
+from collections.abc import Mapping, Sequence
+import numpy as np
 import operator
+import os
+import sys
+import tempfile
 import time
 import random
 
 DEBUG = False
 
-def log(s):
+def log(*parts):
+    # Parts are only formatted when debugging, so that the calls in the loops cost nothing otherwise
     if DEBUG:
-        print(s)
+        print(''.join(str(part) for part in parts))
 
 
 class BellmansOptimizer():
-
-    def __init__(self, player, maze, player_actions, beast_actions, T=15):
+    """
+    Finite horizon optimal control of the player against the random beast, by backward induction.
+    reward_function(t, maze, beast_state, player_state, action, final) is evaluated once per state, at t = T, by
+    the numpy backend, the caches and the compiled state spaces, which all rely on rewards that do not depend on t.
+    A reward that does needs time_dependent_rewards: the numpy backend then evaluates the step rewards at every t,
+    as the python backend always does, and the other shortcuts are refused.
+    """
+    def __init__(self, player, maze, player_actions, beast_actions, T=15, backend='python', reward_function=None,
+                 cache=None, tracer=None, state_space=None, time_dependent_rewards=False):
+        assert backend in ('python', 'numpy'), "Unknown Bellman backend: " + str(backend)
+        assert cache is None or backend == 'numpy', "Cached solutions need the numpy backend"
+        assert state_space is None or (backend == 'numpy' and cache is None), \
+            "Compiled state spaces need the numpy backend, without cache"
+        assert not time_dependent_rewards or (cache is None and state_space is None), \
+            "Cached solutions and compiled state spaces need rewards that do not depend on t"
         self.player = player
         self.maze = maze
         self.T = T
         self.player_actions = player_actions
         self.beast_actions = beast_actions
+        self.backend = backend
+        self.reward_function = reward_function if reward_function is not None else compute_reward
+        self.time_dependent_rewards = time_dependent_rewards
+        # Optional BellmanCache the solutions are looked up in and stored to
+        self.cache = cache
+        # Optional instrumentation.Tracer timing the backward steps and recording their Bellman residuals
+        self.tracer = tracer
+        # Optional state_space.StateSpace the problem is solved on, instead of every (x_p, y_p, x_b, y_b): compiled
+        # with absorbing states, the inner walls and the same reward_function, whose rewards it holds
+        self.state_space = state_space
+        # Solution of the numpy backend, indexed [t, x_p, y_p, x_b, y_b], or [t, row] on a compiled state space
+        self.values = None
+        self.actions = None
         print('Bellman built')
 
     def solve_bellman(self):
+        if self.cache is not None:
+            return self.cache.solve(self)
+        if self.state_space is not None:
+            return self.solve_bellman_compiled()
+        if self.backend == 'numpy':
+            return self.solve_bellman_numpy()
+
+        # Integer cells c = x * height + y, with the transitions read from the compiled maze tables
+        length = self.maze.length
+        height = self.maze.height
+        n_cells = length * height
+        player_next, player_feasible, beast_next, beast_weights = \
+            [table.T.tolist() for table in
+             compute_transition_tables(self.maze, self.player_actions, self.beast_actions)]
+        beast_moves = [[(next_cell, weight) for next_cell, weight in zip(beast_next[c], beast_weights[c]) if weight > 0]
+                       for c in range(n_cells)]
+        player_moves = [[(action, next_cell) for action, next_cell, feasible
+                         in zip(self.player_actions, player_next[c], player_feasible[c]) if feasible]
+                        for c in range(n_cells)]
+        cell_states = [MazeState(c // height, c % height) for c in range(n_cells)]
+        keys = [(c_p // height, c_p % height, c_b // height, c_b % height)
+                for c_p in range(n_cells) for c_b in range(n_cells)]
+        goal = self.maze.cell_id(self.maze.goal_state.x, self.maze.goal_state.y)
+        for key in keys:
+            if self.player.policies[key] == None:
+                self.player.policies[key] = []
+
+        # Values of the step t+1, indexed by c_p * n_cells + c_b
+        v_next = None
         t = self.T
-        i = 0
         while t >= 0:
-            log('Bellmans step: ' +str(t))
-            current_step = self.T - t -1
-            for x_p in range(self.player.maze.length):
-                for y_p in range(self.player.maze.height):
-                    for x_b in range(self.player.maze.length):
-                        for y_b in range(self.player.maze.height):
-                            if self.player.policies[(x_p, y_p, x_b, y_b)] == None:
-                                self.player.policies[(x_p, y_p, x_b, y_b)] = []
-                            log('* -------------------------------------------------------------------- *')
-                            log('State analyzed: '+str(x_p)+', '+str(y_p)+', '+str(x_b)+', '+str(y_b)+ ', step: '+str(t))
-                            dead_end = False
-                            player_state = MazeState(x_p, y_p)
-                            beast_state = MazeState(x_b, y_b)
-                            action = None
-
-                            if t == self.T:
-                                r_T = compute_reward(t, maze=self.maze, player_state=player_state, beast_state=beast_state, action=action, final=True)
-                                dead_end = True
-                                self.player.policies[(x_p, y_p, x_b, y_b)].append(('stay', r_T))
-                                log('     ' + 'u_T = ' + str(r_T))
-
-                            else:
-                                r_t = compute_reward(t, self.maze, player_state, beast_state, action, False)
-                                log('     ' + 'u_t = ' + str(r_t))
-
-                            if not dead_end:
-                                beast_feasible_actions = []
-                                beast_future_states = []
-                                for action in self.beast_actions:
-                                    if self.maze.check_beast_action(action, beast_state):
-                                        beast_feasible_actions.append(action)
-                                        new_beast_state = copy.deepcopy(beast_state)
-                                        new_beast_state.update(action)
-                                        beast_future_states.append(new_beast_state)
-
-                                log('Players feasible actions: ')
-                                player_feasible_actions = self.player_actions
-
-                                if player_state.x == self.maze.goal_state.x and player_state.y == self.maze.goal_state.y:
-                                    player_feasible_actions = ['stay']
-                                    beast_future_states = [copy.deepcopy(beast_state)]
-
-                                if player_state.x == beast_state.x and player_state.y == beast_state.y:
-                                    player_feasible_actions = ['stay']
-                                    beast_future_states = [copy.deepcopy(beast_state)]
-
-                                seq = player_actions
-                                possible_policies_rewards = dict.fromkeys(seq, -1000)
-                                for action in player_feasible_actions:
-                                    u_t = 0
-                                    if self.maze.check_player_action(action, player_state):
-                                        log(action)
-                                        for future_state_beast in beast_future_states:
-                                            future_state_player = copy.deepcopy(player_state)
-                                            future_state_player.update(action)
-                                            x_f_p = future_state_player.x
-                                            y_f_p = future_state_player.y
-                                            x_f_b = future_state_beast.x
-                                            y_f_b = future_state_beast.y
-                                            u_star_next = self.player.policies[(x_f_p, y_f_p, x_f_b, y_f_b)][current_step][1]
-                                            u_t += 1 / len(beast_future_states) * u_star_next
-                                        u_t += r_t
-                                        possible_policies_rewards[action] = u_t
-                                        log('     '+ 'u_t = ' + str(u_t))
-                                #optimal_policy = max(possible_policies_rewards)
-                                optimal_policy = max(possible_policies_rewards.items(), key=operator.itemgetter(1))[0]
-                                optimal_future_cost = possible_policies_rewards[optimal_policy]
-                                log('Policy chosen: ')
-                                self.player.policies[(x_p, y_p, x_b, y_b)].append((optimal_policy, optimal_future_cost))
-                                log(self.player.policies[(x_p, y_p, x_b, y_b)])
+            log('Bellmans step: ', t)
+            if self.tracer is not None:
+                start = self.tracer.now()
+            v_t = [0] * (n_cells * n_cells)
+            for c_p in range(n_cells):
+                player_state = cell_states[c_p]
+                for c_b in range(n_cells):
+                    s = c_p * n_cells + c_b
+                    policy = self.player.policies[keys[s]]
+                    beast_state = cell_states[c_b]
+                    log('* -------------------------------------------------------------------- *')
+                    log('State analyzed: ', keys[s], ', step: ', t)
+
+                    if t == self.T:
+                        r_T = self.reward_function(t, maze=self.maze, player_state=player_state,
+                                                   beast_state=beast_state, action=None, final=True)
+                        policy.append(('stay', r_T))
+                        v_t[s] = r_T
+                        log('     u_T = ', r_T)
+                        continue
+
+                    r_t = self.reward_function(t, self.maze, beast_state, player_state, None, False)
+                    log('     u_t = ', r_t)
+                    possible_policies_rewards = dict.fromkeys(self.player_actions, -1000)
+                    if c_p == goal or c_p == c_b:
+                        # Goal reached or player caught: both agents stay where they are
+                        possible_policies_rewards['stay'] = 0 + 1 / 1 * v_next[s] + r_t
+                    else:
+                        for action, next_p in player_moves[c_p]:
+                            u_t = 0
+                            row = next_p * n_cells
+                            for next_b, weight in beast_moves[c_b]:
+                                u_t += weight * v_next[row + next_b]
+                            u_t += r_t
+                            possible_policies_rewards[action] = u_t
+                            log('     ', action, ': u_t = ', u_t)
+                    optimal_policy = max(possible_policies_rewards.items(), key=operator.itemgetter(1))[0]
+                    optimal_future_cost = possible_policies_rewards[optimal_policy]
+                    policy.append((optimal_policy, optimal_future_cost))
+                    v_t[s] = optimal_future_cost
+                    log('Policy chosen: ', policy[-1])
+            v_next = v_t
+            if self.tracer is not None:
+                self.tracer.stop('bellman_step', start)
+                self.tracer.count('states', n_cells * n_cells)
             t -= 1
 
+    def solve_bellman_numpy(self, initial_values=None, initial_actions=None):
+        """
+        Same backward induction as solve_bellman, but each step is done on the whole (x_p, y_p, x_b, y_b) grid
+        at once by gathering the step t+1 values through precomputed transition index arrays.
+        initial_values and initial_actions can hold the solution of a shorter horizon T0 <= T: since the dynamics
+        and the rewards do not depend on t, it is the last T0+1 steps of this one and only T-T0 steps are computed.
+        """
+        assert 'stay' in self.player_actions, "The player needs the 'stay' action to rest in absorbing states"
+        length = self.maze.length
+        height = self.maze.height
+        n_cells = length * height
+        stay = self.player_actions.index('stay')
+        transitions = compute_transition_tables(self.maze, self.player_actions, self.beast_actions)
+        r_final, r_step, absorbing = self.reward_arrays()
+
+        values = np.empty((self.T + 1, n_cells, n_cells))
+        actions = np.empty((self.T + 1, n_cells, n_cells), dtype=np.uint8)
+        if initial_values is None:
+            first_step = self.T
+            values[self.T] = r_final
+            actions[self.T] = stay
+        else:
+            first_step = self.T + 1 - len(initial_values)
+            assert first_step >= 0, "The initial solution has a longer horizon than T"
+            assert not self.time_dependent_rewards, "Only rewards that do not depend on t can extend a solution"
+            values[first_step:] = np.reshape(initial_values, (-1, n_cells, n_cells))
+            actions[first_step:] = np.reshape(initial_actions, (-1, n_cells, n_cells))
+
+        for t in range(first_step - 1, -1, -1):
+            log('Bellmans step: ', t)
+            if self.tracer is not None:
+                start = self.tracer.now()
+            v_next = values[t + 1]
+            if self.time_dependent_rewards:
+                r_step = self.reward_arrays(t)[1]
+            bellman_backward_step(v_next, values[t], actions[t], transitions, r_step, absorbing, stay)
+            if self.tracer is not None:
+                self.tracer.stop('bellman_step', start)
+                self.tracer.count('states', n_cells * n_cells)
+                self.tracer.record('bellman_residual', np.abs(values[t] - v_next).max())
+
+        shape = (self.T + 1, length, height, length, height)
+        self.set_solution(values.reshape(shape), actions.reshape(shape))
+
+    def reward_arrays(self, t=None):
+        """
+        Final and step rewards, and the absorbing states (goal reached or player caught), over the flattened
+        (player cell, beast cell) pairs. The step rewards are the ones of step t, T by default; the final ones are
+        always the ones of T.
+        """
+        if t is None:
+            t = self.T
+        height = self.maze.height
+        n_cells = self.maze.length * height
+        states = np.arange(n_cells * n_cells)
+        r_final = reward_vector(self.reward_function, self.maze, states, self.T, final=True).reshape(n_cells, n_cells)
+        r_step = reward_vector(self.reward_function, self.maze, states, t, final=False).reshape(n_cells, n_cells)
+        goal = self.maze.goal_state.x * height + self.maze.goal_state.y
+        cells = np.arange(n_cells)
+        absorbing = (cells[:, None] == goal) | (cells[:, None] == cells[None, :])
+        return r_final, r_step, absorbing
+
+    def solve_bellman_compiled(self):
+        """
+        Same backward induction as solve_bellman_numpy, over the rows of the compiled state space only: the
+        unreachable states are left out and each class of absorbing states is a single row.
+        """
+        space = self.state_space
+        assert 'stay' in self.player_actions, "The player needs the 'stay' action to rest in absorbing states"
+        assert space.player_actions == list(self.player_actions) and space.beast_actions == list(self.beast_actions), \
+            "The state space was compiled for other actions"
+        assert space.absorbing and space.player_walls, \
+            "The state space must have the absorbing states and the inner walls of the finite horizon game"
+        assert space.reward_function is self.reward_function, "The state space was compiled for other rewards"
+        n_actions = len(self.player_actions)
+        stay = self.player_actions.index('stay')
+        n = space.n_transient
+        r_step = space.step_rewards
+
+        values = np.empty((self.T + 1, space.n_rows))
+        actions = np.empty((self.T + 1, space.n_rows), dtype=np.uint8)
+        values[self.T] = space.final_rewards
+        actions[self.T] = stay
+        q = np.empty((n_actions, n))
+        for t in range(self.T - 1, -1, -1):
+            log('Bellmans step: ', t)
+            if self.tracer is not None:
+                start = self.tracer.now()
+            v_next = values[t + 1]
+            for i in range(n_actions):
+                # Accumulated in the same order as the other backends, so that the values agree to the last bit
+                u_t = np.zeros(n)
+                for j in range(len(self.beast_actions)):
+                    u_t += space.weights[j] * v_next[space.next_rows[i, j]]
+                u_t += r_step[:n]
+                q[i] = np.where(space.feasible[i], u_t, -1000)
+            actions[t, :n] = np.argmax(q, axis=0)
+            values[t, :n] = np.take_along_axis(q, actions[t, :n][None].astype(np.intp), axis=0)[0]
+            # Absorbing rows: the player stays and the beast does not move anymore
+            actions[t, n:] = stay
+            values[t, n:] = v_next[n:] + r_step[n:]
+            if self.tracer is not None:
+                self.tracer.stop('bellman_step', start)
+                self.tracer.count('states', space.n_rows)
+                self.tracer.record('bellman_residual', np.abs(values[t] - v_next).max())
+        self.set_solution(values, actions)
+
+    def set_solution(self, values, actions):
+        self.values = values
+        self.actions = actions
+        if self.state_space is not None:
+            self.player.policies = CompiledPolicies(self.actions, self.values, self.player_actions, self.state_space)
+        else:
+            self.player.policies = TensorPolicies(self.actions, self.values, self.player_actions)
+
+
+    def solution_arrays(self):
+        """
+        Dense (T+1, L, H, L, H) values and action indices of the solution, converted from the policies lists when
+        the python backend was used. On a compiled state space the unreachable states get NaN values and 'stay'.
+        """
+        self.check_solution_held()
+        if self.state_space is not None:
+            stay = self.player_actions.index('stay')
+            return self.state_space.expand(self.values, np.nan), self.state_space.expand(self.actions, stay)
+        if self.values is not None:
+            return self.values, self.actions
+        shape = (self.T + 1, self.maze.length, self.maze.height, self.maze.length, self.maze.height)
+        values = np.empty(shape)
+        actions = np.empty(shape, dtype=np.uint8)
+        for state, policy in self.player.policies.items():
+            for i, (action, value) in enumerate(policy):
+                actions[(self.T - i,) + state] = self.player_actions.index(action)
+                values[(self.T - i,) + state] = value
+        return values, actions
+
+    def solution_actions(self):
+        # The action indices of solution_arrays alone
+        self.check_solution_held()
+        if self.state_space is not None:
+            return self.state_space.expand(self.actions, self.player_actions.index('stay'))
+        if self.actions is not None:
+            return self.actions
+        shape = (self.T + 1, self.maze.length, self.maze.height, self.maze.length, self.maze.height)
+        actions = np.empty(shape, dtype=np.uint8)
+        for state, policy in self.player.policies.items():
+            for i, (action, _) in enumerate(policy):
+                actions[(self.T - i,) + state] = self.player_actions.index(action)
+        return actions
+
+    def check_solution_held(self):
+        if self.values is None and isinstance(self.player.policies, CompactPolicies):
+            raise ValueError('The dense solution was released by compact_policies')
+
+    def compact_policies(self, keep_values=False, run_length=True):
+        """
+        Plug the solution in the player as CompactPolicies, and return them. The dense solution is released: the
+        values are only converted when keep_values, and the optimizer does not hold the solution anymore.
+        """
+        if keep_values:
+            values, actions = self.solution_arrays()
+        else:
+            values, actions = None, self.solution_actions()
+        policies = CompactPolicies(actions, self.player_actions, values, keep_values, run_length)
+        del values, actions
+        self.values = None
+        self.actions = None
+        self.player.policies = policies
+        return policies
+
+    def save_solution(self, path):
+        values, actions = self.solution_arrays()
+        meta = {'maze': checkpoint.maze_to_meta(self.maze), 'T': self.T,
+                'player_actions': self.player_actions, 'beast_actions': self.beast_actions}
+        checkpoint.save_checkpoint(path, 'bellman', {'values': values, 'actions': actions}, meta)
+
+    @classmethod
+    def load_solution(cls, path, player=None, mmap=True):
+        """
+        Load a solution saved with save_solution and plug it in the player (built at (0, 0) if not given).
+        With mmap the tables are read-only views on the file, shared by every process loading it.
+        """
+        meta, arrays = checkpoint.load_checkpoint(path, 'bellman', mmap=mmap)
+        maze = checkpoint.maze_from_meta(meta['maze'])
+        if player is None:
+            player = MazePlayer(MazeState(0, 0), maze, possible_actions=meta['player_actions'])
+        optimizer = cls(player, maze, meta['player_actions'], meta['beast_actions'], meta['T'], backend='numpy')
+        optimizer.set_solution(arrays['values'], arrays['actions'])
+        return optimizer
+
+
+class TensorPolicies(Mapping):
+    """
+    Read only view of a dense Bellman solution with the same interface as MazePlayer.policies:
+    policies[(x_p, y_p, x_b, y_b)][-(t+1)] -> (action, value)
+    """
+    def __init__(self, actions, values, player_actions):
+        self.actions = actions
+        self.values = values
+        self.player_actions = player_actions
 
+    def __getitem__(self, state):
+        if len(state) != 4 or not all(0 <= c < n for c, n in zip(state, self.actions.shape[1:])):
+            raise KeyError(state)
+        return StatePolicy(self, tuple(state))
 
+    def __iter__(self):
+        return iter(np.ndindex(*self.actions.shape[1:]))
 
+    def __len__(self):
+        return int(np.prod(self.actions.shape[1:]))
 
 
+class CompiledPolicies(Mapping):
+    """
+    TensorPolicies of a solution over the rows of a state_space.StateSpace: only the reachable states are keys.
+    """
+    def __init__(self, actions, values, player_actions, state_space):
+        self.actions = actions
+        self.values = values
+        self.player_actions = player_actions
+        self.state_space = state_space
+
+    def __getitem__(self, state):
+        return StatePolicy(self, (self.state_space.row(state),))
+
+    def __iter__(self):
+        return self.state_space.reachable_states()
+
+    def __len__(self):
+        return self.state_space.n_reachable
+
+
+class StatePolicy(Sequence):
+    """
+    Policy of a single state, ordered as the lists built by solve_bellman: the first entry is the one of t = T.
+    """
+    def __init__(self, policies, state):
+        self.policies = policies
+        self.state = state
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('policy index out of range')
+        return self.entry(n - 1 - i)
+
+    def entry(self, t):
+        action = self.policies.player_actions[self.policies.actions[(t,) + self.state]]
+        return action, float(self.policies.values[(t,) + self.state])
+
+    def __len__(self):
+        return self.policies.actions.shape[0]
+
+
+class CompactPolicies(Mapping):
+    """
+    MazePlayer.policies store of a finite horizon solution in one byte per state and step: actions[t, s] holds
+    the index of the action in player_actions, s = (x_p, y_p, x_b, y_b) flattened. Values are kept as float32
+    with keep_values, and read as None otherwise.
+    With run_length the actions are stored per state as runs over t instead, since the optimal action of most
+    states only changes a few times over the horizon:
+        run_starts[offsets[s]:offsets[s+1]], run_actions[...]: first step and action of each run of state s
+    and a lookup is a binary search among the runs of the state.
+    """
+    def __init__(self, actions, player_actions, values=None, keep_values=False, run_length=True):
+        self.player_actions = list(player_actions)
+        self.shape = actions.shape[1:]
+        self.n_steps = actions.shape[0]
+        self.run_length = run_length
+        actions = np.asarray(actions, dtype=np.uint8).reshape(self.n_steps, -1)
+        self.values = None
+        if keep_values and values is not None:
+            self.values = np.asarray(values, dtype=np.float32).reshape(self.n_steps, -1)
+        if not run_length:
+            self.actions = np.ascontiguousarray(actions)
+            return
+        self.actions = None
+        by_state = actions.T
+        starts = np.ones(by_state.shape, dtype=bool)
+        starts[:, 1:] = by_state[:, 1:] != by_state[:, :-1]
+        time_dtype = np.uint16 if self.n_steps <= np.iinfo(np.uint16).max else np.uint32
+        self.run_starts = np.nonzero(starts)[1].astype(time_dtype)
+        self.run_actions = by_state[starts]
+        offsets_dtype = np.uint32 if len(self.run_starts) <= np.iinfo(np.uint32).max else np.int64
+        self.offsets = np.zeros(len(by_state) + 1, dtype=offsets_dtype)
+        np.cumsum(starts.sum(axis=1), out=self.offsets[1:])
+
+    def state_index(self, state):
+        if len(state) != 4 or not all(0 <= c < n for c, n in zip(state, self.shape)):
+            raise KeyError(state)
+        return int(np.ravel_multi_index(tuple(state), self.shape))
+
+    def action_index(self, t, s):
+        if not self.run_length:
+            return self.actions[t, s]
+        start, stop = self.offsets[s], self.offsets[s + 1]
+        run = start + int(np.searchsorted(self.run_starts[start:stop], t, side='right')) - 1
+        return self.run_actions[run]
+
+    def dense_actions(self):
+        # (T+1, n_states) action indices, expanded from the runs if needed
+        if not self.run_length:
+            return self.actions
+        run_stops = np.empty(len(self.run_starts), dtype=np.int64)
+        run_stops[:-1] = self.run_starts[1:]
+        # The last run of each state lasts until the horizon
+        run_stops[self.offsets[1:] - 1] = self.n_steps
+        lengths = run_stops - self.run_starts
+        return np.repeat(self.run_actions, lengths).reshape(len(self.offsets) - 1, self.n_steps).T
+
+    def nbytes(self):
+        arrays = [self.actions, self.values] if not self.run_length else \
+            [self.run_starts, self.run_actions, self.offsets, self.values]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def __getitem__(self, state):
+        return CompactStatePolicy(self, self.state_index(state))
+
+    def __iter__(self):
+        return iter(np.ndindex(*self.shape))
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+
+class CompactStatePolicy(StatePolicy):
+    def entry(self, t):
+        action = self.policies.player_actions[self.policies.action_index(t, self.state)]
+        if self.policies.values is None:
+            return action, None
+        return action, float(self.policies.values[t, self.state])
+
+    def __len__(self):
+        return self.policies.n_steps
+
+
+def compute_transition_tables(maze, player_actions, beast_actions):
+    """
+    Select, from the compiled maze tables, where each action leads and whether it is allowed:
+        player_next[i, c], player_feasible[i, c]: cell reached with player_actions[i], and if that move is allowed
+        beast_next[j, c], beast_weights[j, c]: cell reached with beast_actions[j], and its probability when the
+                                               beast picks uniformly among its feasible moves
+    Infeasible moves leave the agent in place.
+    """
+    tables = maze.tables()
+    player_codes = [ACTION_CODES[action] for action in player_actions]
+    beast_codes = [ACTION_CODES[action] for action in beast_actions]
+    player_feasible = tables.feasible(tables.player_masks, player_codes)
+    beast_feasible = tables.feasible(tables.beast_masks, beast_codes)
+    beast_weights = np.where(beast_feasible, 1 / beast_feasible.sum(axis=0), 0)
+    return tables.player_next[player_codes], player_feasible, tables.beast_next[beast_codes], beast_weights
+
+
+def reward_vector(reward_function, maze, states, t, final, n_pursuers=None):
+    """
+    reward_function(t, maze, beast_state, player_state, None, final) of each encoded state
+    s = player_cell * n_cells + beast_cell, cell = x * height + y. With n_pursuers the states encode that many
+    beasts, as in multi_pursuit.JointStates, and reward_function gets the list of their states.
+    """
+    height = maze.height
+    n_cells = maze.length * height
+    cell_states = [MazeState(c // height, c % height) for c in range(n_cells)]
+    rewards = np.empty(len(states))
+    for k, s in enumerate(np.asarray(states).tolist()):
+        if n_pursuers is None:
+            player_cell, beast_cell = divmod(s, n_cells)
+            beasts = cell_states[beast_cell]
+        else:
+            beasts = []
+            for _ in range(n_pursuers):
+                s, beast_cell = divmod(s, n_cells)
+                beasts.append(cell_states[beast_cell])
+            player_cell = s
+            beasts.reverse()
+        rewards[k] = reward_function(t, maze, beasts, cell_states[player_cell], None, final)
+    return rewards
+
+
+def bellman_backward_step(v_next, values, actions, transitions, r_step, absorbing, stay, rows=slice(None)):
+    """
+    One step of the backward induction of solve_bellman_numpy on the player cells rows: values[rows] and
+    actions[rows] of step t are written in place from the step t+1 values v_next of every (player, beast) pair.
+    Every entry only depends on v_next, so disjoint rows can be computed separately and give the same bits.
+    """
+    player_next, player_feasible, beast_next, beast_weights = transitions
+    r_step = r_step[rows]
+    absorbing = absorbing[rows]
+    q = np.empty((len(player_next),) + r_step.shape)
+    for i in range(len(player_next)):
+        # Expectation over the uniformly chosen feasible beast moves, accumulated in the same order as
+        # solve_bellman so that both backends agree to the last bit
+        u_t = np.zeros(r_step.shape)
+        next_p = player_next[i][rows][:, None]
+        for j in range(len(beast_next)):
+            u_t += beast_weights[j][None, :] * v_next[next_p, beast_next[j][None, :]]
+        u_t += r_step
+        q[i] = np.where(player_feasible[i][rows][:, None], u_t, -1000)
+    # In absorbing states only 'stay' is allowed and the beast does not move anymore
+    q[:, absorbing] = -1000
+    q[stay][absorbing] = (v_next[rows] + r_step)[absorbing]
+    actions[rows] = np.argmax(q, axis=0)
+    values[rows] = np.take_along_axis(q, actions[rows][None].astype(np.intp), axis=0)[0]
 
 
 def compute_reward(t, maze, beast_state, player_state, action, final):
@@ -154,22 +592,19 @@ if __name__ == '__main__':
     print('Optimal policy for the state: ', str(state))
     for i in range(T+1):
         print(policies[-(i+1)])
-    my_game = MazeGame(player=p1, beast=b1, maze=our_maze)
     print("Player policies computed.")
-    print("Starting the game")
-    for j in range(0):
+    print("Starting the games")
+    # Played headless and recorded, then replayed from the file: printing every frame would dominate the games.
+    # The games are kept in the file given as first argument, or in a temporary one otherwise
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        games_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tmp_dir, 'games.traj')
+        with TrajectoryRecorder(games_path, our_maze) as recorder:
+            for j in range(1000):
+                p1.state = init_p_state.copy()
+                b1.state = init_b_state.copy()
+                my_game = MazeGame(player=p1, beast=b1, maze=our_maze, recorder=recorder)
+                for i in range(T):
+                    my_game.step_simulation()
         print('**********************************************')
-        print('final game: '+str(j))
-        del my_game
-        my_game = MazeGame(player=p1, beast=b1, maze=our_maze)
-        for i in range(T):
-            my_game.plot_game()
-            my_game.step_simulation()
-        my_game.plot_game()
-
-        my_game.plot_game()
-
-
-
-
-
+        print('final game: 0')
+        replay(games_path, games=[0])
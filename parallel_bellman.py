@@ -0,0 +1,93 @@
+import numpy as np
+import multiprocessing as mp
+from threading import BrokenBarrierError
+from optimal_control import bellman_backward_step, compute_transition_tables
+from shared_arrays import SharedArrays
+
+
+class SharedBellmanTables(SharedArrays):
+    """
+    Values and actions of every step of a BellmansOptimizer solution, with the step rewards and the absorbing
+    states they are computed from, in shared memory: workers read step t+1 and write their rows of step t in place.
+    """
+    def __init__(self, T, n_cells, names=None):
+        self.T = T
+        self.n_cells = n_cells
+        grid = (n_cells, n_cells)
+        specs = [('values', np.float64, (T + 1,) + grid), ('actions', np.uint8, (T + 1,) + grid),
+                 ('r_step', np.float64, grid), ('absorbing', np.bool_, grid)]
+        super().__init__(specs, names)
+
+
+class ParallelBellmansOptimizer:
+    """
+    Runs the backward induction of a BellmansOptimizer on num_workers processes. The player cells are split in
+    num_workers contiguous ranges and each worker computes the values and actions of its range at every step,
+    from the previous step in shared memory; a barrier closes each step. Every entry is computed by the same
+    operations as in solve_bellman_numpy, so the solution is bit-identical to the serial one.
+    """
+    def __init__(self, optimizer, num_workers):
+        self.optimizer = optimizer
+        self.num_workers = num_workers
+
+    def solve_bellman(self):
+        optimizer = self.optimizer
+        assert 'stay' in optimizer.player_actions, "The player needs the 'stay' action to rest in absorbing states"
+        assert not optimizer.time_dependent_rewards, "The workers share step rewards that do not depend on t"
+        assert optimizer.state_space is None, "The workers solve the dense (player cell, beast cell) grid only"
+        assert optimizer.cache is None, "Parallel solutions are not looked up in nor stored to a cache"
+        maze = optimizer.maze
+        T = optimizer.T
+        n_cells = maze.length * maze.height
+        stay = optimizer.player_actions.index('stay')
+        transitions = compute_transition_tables(maze, optimizer.player_actions, optimizer.beast_actions)
+        r_final, r_step, absorbing = optimizer.reward_arrays()
+        bounds = np.linspace(0, n_cells, min(self.num_workers, n_cells) + 1).astype(int)
+        partitions = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+        tables = SharedBellmanTables(T, n_cells)
+        tables.values[T] = r_final
+        tables.actions[T] = stay
+        tables.r_step[:] = r_step
+        tables.absorbing[:] = absorbing
+        barrier = mp.Barrier(len(partitions) + 1)
+        workers = [mp.Process(target=run_worker, args=(tables.names, T, n_cells, transitions, stay, rows, barrier))
+                   for rows in partitions]
+        tracer = optimizer.tracer
+        try:
+            for worker in workers:
+                worker.start()
+            for t in range(T - 1, -1, -1):
+                if tracer is not None:
+                    start = tracer.now()
+                # Released once every worker has written its rows of step t
+                barrier.wait()
+                if tracer is not None:
+                    tracer.stop('bellman_step', start)
+                    tracer.count('states', n_cells * n_cells)
+            for worker in workers:
+                worker.join()
+            shape = (T + 1, maze.length, maze.height, maze.length, maze.height)
+            optimizer.set_solution(np.array(tables.values).reshape(shape), np.array(tables.actions).reshape(shape))
+        except BrokenBarrierError:
+            raise RuntimeError('A Bellman worker failed, see its traceback above')
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            tables.close()
+
+
+def run_worker(names, T, n_cells, transitions, stay, rows, barrier):
+    tables = SharedBellmanTables(T, n_cells, names=names)
+    rows = slice(*rows)
+    try:
+        for t in range(T - 1, -1, -1):
+            bellman_backward_step(tables.values[t + 1], tables.values[t], tables.actions[t], transitions,
+                                  tables.r_step, tables.absorbing, stay, rows)
+            barrier.wait()
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        tables.close()
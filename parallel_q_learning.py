@@ -0,0 +1,111 @@
+import numpy as np
+import multiprocessing as mp
+from threading import BrokenBarrierError
+from tqdm import tqdm
+from shared_arrays import SharedArrays
+
+
+class SharedQTable(SharedArrays):
+    """
+    Q values and update counts of the global table and of one working copy per worker, all in shared memory so
+    that workers and merges never pickle the tables.
+    """
+    def __init__(self, shape, num_workers, names=None):
+        self.shape = shape
+        self.num_workers = num_workers
+        specs = [('q', np.float64, shape), ('n', np.int32, shape),
+                 ('q_slots', np.float64, (num_workers,) + shape), ('n_slots', np.int32, (num_workers,) + shape)]
+        super().__init__(specs, names)
+
+    def merge(self):
+        """
+        Count-weighted merge of the worker copies into the global table. With the 1/n step size a Q value is the
+        mean of the targets it was updated with, so the merged value is the mean over the targets of every worker,
+        and the merged count is the total number of updates.
+        """
+        n_0 = self.n.astype(np.int64)
+        sum_0 = n_0 * self.q
+        new_updates = np.zeros(self.shape, dtype=np.int64)
+        new_targets = np.zeros(self.shape)
+        for k in range(self.num_workers):
+            n_k = self.n_slots[k].astype(np.int64)
+            new_updates += n_k - n_0
+            new_targets += n_k * self.q_slots[k] - sum_0
+        n_total = n_0 + new_updates
+        updated = new_updates > 0
+        self.q[updated] = (sum_0[updated] + new_targets[updated]) / n_total[updated]
+        self.n[:] = n_total
+
+
+class ParallelQLearning:
+    """
+    Runs a QLearning experience on num_workers processes. Each worker steps its own batched simulation, seeded by
+    seeds[k], on a private copy of the Q function; every sync_every steps the copies are merged into the global
+    table, which all the workers start the next round from. Rounds are synchronous, so a fixed set of seeds
+    always gives the same Q function.
+    """
+    def __init__(self, q_learning, num_workers, seeds=None, num_envs=256, sync_every=100):
+        self.q_learning = q_learning
+        self.num_workers = num_workers
+        self.seeds = list(seeds) if seeds is not None else list(range(num_workers))
+        assert len(self.seeds) == num_workers, "One seed per worker is needed"
+        self.num_envs = num_envs
+        self.sync_every = sync_every
+
+    def simulate_and_learn(self):
+        q_learning = self.q_learning
+        transitions_per_round = self.num_workers * self.num_envs * self.sync_every
+        num_rounds = -(-q_learning.num_iterations // transitions_per_round)
+        rewards = q_learning.reward_table()
+
+        table = SharedQTable(q_learning.q_table.q.shape, self.num_workers)
+        table.q[:] = q_learning.q_table.q
+        table.n[:] = q_learning.q_table.n
+        barrier = mp.Barrier(self.num_workers + 1)
+        workers = [mp.Process(target=run_worker, args=(q_learning, table.names, table.shape, self.num_workers, k,
+                                                       self.seeds[k], self.num_envs, self.sync_every, num_rounds,
+                                                       rewards, barrier))
+                   for k in range(self.num_workers)]
+        try:
+            for worker in workers:
+                worker.start()
+            for _ in tqdm(range(num_rounds)):
+                # Wait for the workers to finish the round, merge, then let them start the next one
+                barrier.wait()
+                table.merge()
+                q_learning.q_initial_state_history.append(
+                    float(table.q[q_learning.initial_row, q_learning.initial_state_actions].max()))
+                barrier.wait()
+            for worker in workers:
+                worker.join()
+            q_learning.q_table.q[:] = table.q
+            q_learning.q_table.n[:] = table.n
+        except BrokenBarrierError:
+            raise RuntimeError('A Q-learning worker failed, see its traceback above')
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            table.close()
+
+
+def run_worker(q_learning, names, shape, num_workers, k, seed, num_envs, sync_every, num_rounds, rewards, barrier):
+    table = SharedQTable(shape, num_workers, names=names)
+    try:
+        q_learning.q_table.q = table.q_slots[k]
+        q_learning.q_table.n = table.n_slots[k]
+        simulation = q_learning.init_batched_simulation(num_envs, seed)
+        for _ in range(num_rounds):
+            table.q_slots[k] = table.q
+            table.n_slots[k] = table.n
+            q_learning.q_initial_state_history = []
+            q_learning.learn_batched(simulation, rewards, sync_every, progress=False)
+            barrier.wait()
+            barrier.wait()
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        q_learning.q_table.q = None
+        q_learning.q_table.n = None
+        table.close()
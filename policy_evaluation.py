@@ -0,0 +1,166 @@
+"""
+Monte Carlo evaluation of a solved policy: many games of MazeGame played at once on arrays of cells, with the
+beast drawn among its feasible moves only.
+"""
+import numpy as np
+from statistics import NormalDist
+from optimal_control import TensorPolicies, CompiledPolicies, CompactPolicies, compute_transition_tables
+from maze_utilities import ACTION_CODES
+
+
+def policy_table(policies, maze, player_actions, T):
+    """
+    Action indices of a MazePlayer.policies mapping at every time step, as a (T, n_cells, n_cells) array over
+    (t, player cell, beast cell): entry t is policies[state][-(t+1)], the action MazePlayer.choose_action plays.
+    """
+    n_cells = maze.length * maze.height
+    if isinstance(policies, TensorPolicies):
+        return np.asarray(policies.actions[:T]).reshape(T, n_cells, n_cells)
+    if isinstance(policies, CompactPolicies):
+        return policies.dense_actions()[:T].reshape(T, n_cells, n_cells)
+    if isinstance(policies, CompiledPolicies):
+        actions = policies.state_space.expand(policies.actions[:T], player_actions.index('stay'))
+        return actions.reshape(T, n_cells, n_cells)
+    table = np.zeros((T, n_cells, n_cells), dtype=np.uint8)
+    action_index = {action: i for i, action in enumerate(player_actions)}
+    for (x_p, y_p, x_b, y_b), policy in policies.items():
+        if not policy:
+            continue
+        for t in range(T):
+            table[t, maze.cell_id(x_p, y_p), maze.cell_id(x_b, y_b)] = action_index[policy[-(t + 1)][0]]
+    return table
+
+
+def wilson_interval(successes, n, z):
+    # Confidence interval of a proportion, still meaningful when it is close to 0 or 1
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half_width = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return float(center - half_width), float(center + half_width)
+
+
+class PolicyEvaluator:
+    """
+    Plays games of T steps of the player following policies against the beast, as MazeGame does: at step t the
+    player plays policies[state][-(t+1)] and the beast a uniformly chosen feasible move. A game ends when the
+    player reaches the goal (a success, as compute_reward counts it even if the beast is there) or shares its
+    cell with the beast (a capture). Games are played batch_size at a time.
+    """
+    def __init__(self, maze, policies, player_actions, beast_actions, T, batch_size=65536):
+        self.maze = maze
+        self.player_actions = list(player_actions)
+        self.beast_actions = list(beast_actions)
+        self.T = T
+        self.batch_size = batch_size
+        self.n_cells = maze.length * maze.height
+        self.actions = policy_table(policies, maze, self.player_actions, T)
+        self.player_next, _, self.beast_next, beast_weights = \
+            compute_transition_tables(maze, self.player_actions, self.beast_actions)
+        # Inverse transform sampling of the beast moves: the first move whose cumulative weight exceeds the draw.
+        # The last feasible move of each cell takes every draw left, whatever the rounding of the sums
+        self.beast_cumulative = np.cumsum(beast_weights, axis=0)
+        last = len(beast_weights) - 1 - np.argmax(beast_weights[::-1] > 0, axis=0)
+        self.beast_cumulative[last, np.arange(self.n_cells)] = np.inf
+        self.goal = maze.cell_id(maze.goal_state.x, maze.goal_state.y)
+        # ACTION_CODES of the action indices, for the recorded trajectories
+        self.player_codes = np.array([ACTION_CODES[action] for action in self.player_actions], dtype=np.uint8)
+        self.beast_codes = np.array([ACTION_CODES[action] for action in self.beast_actions], dtype=np.uint8)
+
+    def play(self, player_cells, beast_cells, rng, recorder=None):
+        """
+        Play one game from each pair of cells. Returns the step at which each game was won, and the one at which
+        it was lost, -1 when it did not happen within T steps. A trajectories.TrajectoryRecorder recorder gets
+        every step of the games until they end.
+        """
+        player_cells = np.array(player_cells, dtype=np.intp)
+        beast_cells = np.array(beast_cells, dtype=np.intp)
+        won = np.where(player_cells == self.goal, 0, -1)
+        lost = np.where((won < 0) & (player_cells == beast_cells), 0, -1)
+        playing = (won < 0) & (lost < 0)
+        if recorder is not None:
+            games = recorder.start_games(player_cells, beast_cells)
+        for t in range(self.T):
+            actions = self.actions[t, player_cells, beast_cells]
+            draws = rng.random(len(beast_cells))
+            moves = (self.beast_cumulative[:, beast_cells] > draws).argmax(axis=0)
+            # Finished games stay where they ended
+            player_cells = np.where(playing, self.player_next[actions, player_cells], player_cells)
+            beast_cells = np.where(playing, self.beast_next[moves, beast_cells], beast_cells)
+            if recorder is not None:
+                recorder.record_batch(games[playing], t + 1, player_cells[playing], beast_cells[playing],
+                                      self.player_codes[actions[playing]], self.beast_codes[moves[playing]])
+            at_goal = playing & (player_cells == self.goal)
+            caught = playing & ~at_goal & (player_cells == beast_cells)
+            won[at_goal] = t + 1
+            lost[caught] = t + 1
+            playing &= ~(at_goal | caught)
+            if not playing.any():
+                break
+        return won, lost
+
+    def evaluate(self, player_state, beast_state, n_games=10**6, seed=None, confidence=0.95, recorder=None):
+        """
+        Play n_games games from the given start, recorded by recorder if given. The same seed gives the same games.
+        """
+        rng = np.random.default_rng(seed)
+        player_cell = self.maze.cell_id(player_state.x, player_state.y)
+        beast_cell = self.maze.cell_id(beast_state.x, beast_state.y)
+        evaluation = PolicyEvaluation(self.T, confidence)
+        for start in range(0, n_games, self.batch_size):
+            size = min(self.batch_size, n_games - start)
+            won, lost = self.play(np.full(size, player_cell), np.full(size, beast_cell), rng, recorder)
+            evaluation.add(won, lost)
+        return evaluation
+
+
+class PolicyEvaluation:
+    """
+    Outcomes of evaluated games, accumulated batch by batch:
+        time_to_goal[t], time_to_capture[t]: number of games won / lost at step t
+    The intervals are Wilson intervals for the rates, normal ones for the mean times, at the given confidence.
+    """
+    def __init__(self, T, confidence=0.95):
+        self.T = T
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.n_games = 0
+        self.time_to_goal = np.zeros(T + 1, dtype=np.int64)
+        self.time_to_capture = np.zeros(T + 1, dtype=np.int64)
+
+    def add(self, won, lost):
+        self.n_games += len(won)
+        self.time_to_goal += np.bincount(won[won >= 0], minlength=self.T + 1)
+        self.time_to_capture += np.bincount(lost[lost >= 0], minlength=self.T + 1)
+
+    @property
+    def successes(self):
+        return int(self.time_to_goal.sum())
+
+    @property
+    def captures(self):
+        return int(self.time_to_capture.sum())
+
+    def success_probability(self):
+        # (estimate, low, high)
+        return (self.successes / max(self.n_games, 1),) + wilson_interval(self.successes, self.n_games, self.z)
+
+    def capture_rate(self):
+        return (self.captures / max(self.n_games, 1),) + wilson_interval(self.captures, self.n_games, self.z)
+
+    def mean_time_to_goal(self):
+        # Over the won games only; NaN when none was won
+        if self.successes == 0:
+            return float('nan'), float('nan'), float('nan')
+        steps = np.arange(self.T + 1)
+        mean = (steps * self.time_to_goal).sum() / self.successes
+        variance = (self.time_to_goal * (steps - mean) ** 2).sum() / max(self.successes - 1, 1)
+        half_width = self.z * np.sqrt(variance / self.successes)
+        return float(mean), float(mean - half_width), float(mean + half_width)
+
+    def summary(self):
+        return {'games': self.n_games, 'confidence': self.confidence,
+                'success_probability': self.success_probability(), 'capture_rate': self.capture_rate(),
+                'mean_time_to_goal': self.mean_time_to_goal(),
+                'time_to_goal': self.time_to_goal.tolist(), 'time_to_capture': self.time_to_capture.tolist()}
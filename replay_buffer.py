@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class ReplayBuffer:
+    """
+    Fixed capacity circular buffer of integer encoded transitions (s, a, r, s'), stored in preallocated arrays.
+    Once full, the oldest transitions are overwritten.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        self.next_states = np.zeros(capacity, dtype=np.int64)
+        self.position = 0
+        self.size = 0
+
+    def add(self, state, action, reward, next_state):
+        i = self.position
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add_batch(self, states, actions, rewards, next_states):
+        idx = (self.position + np.arange(len(states))) % self.capacity
+        self.states[idx] = states
+        self.actions[idx] = actions
+        self.rewards[idx] = rewards
+        self.next_states[idx] = next_states
+        self.position = int((self.position + len(states)) % self.capacity)
+        self.size = min(self.size + len(states), self.capacity)
+
+    def sample(self, batch_size, rng):
+        # Uniform draw, with replacement, among the stored transitions
+        idx = rng.integers(0, self.size, size=batch_size)
+        return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx]
+
+    def __len__(self):
+        return self.size
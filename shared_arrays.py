@@ -0,0 +1,38 @@
+"""
+Numpy arrays in multiprocessing shared memory, created by one process and attached to by name in the others.
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArrays:
+    """
+    One shared memory block per (field, dtype, shape) spec, viewed as the array attribute field. Without names the
+    blocks are created, and owned: close() then unlinks them. With names, the blocks of another SharedArrays are
+    attached to, in the order of specs.
+    """
+    def __init__(self, specs, names=None):
+        self.fields = [field for field, _, _ in specs]
+        self.owner = names is None
+        self.blocks = []
+        for i, (field, dtype, field_shape) in enumerate(specs):
+            size = int(np.prod(field_shape)) * np.dtype(dtype).itemsize
+            if self.owner:
+                block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            else:
+                block = shared_memory.SharedMemory(name=names[i])
+            self.blocks.append(block)
+            setattr(self, field, np.ndarray(field_shape, dtype=dtype, buffer=block.buf))
+
+    @property
+    def names(self):
+        return [block.name for block in self.blocks]
+
+    def close(self):
+        # The arrays are dropped first: a block cannot be closed while a view exports its buffer
+        for field in self.fields:
+            setattr(self, field, None)
+        for block in self.blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
@@ -0,0 +1,130 @@
+"""
+Joint (player, beast) states a problem can actually visit: the states reachable from its start states, with the
+absorbing states of equal rewards collapsed into a single one. Solver and learner tables are allocated over these
+rows instead of the full L*H*L*H product.
+"""
+import numpy as np
+from maze_utilities import ACTION_CODES
+from optimal_control import compute_reward, compute_transition_tables, reward_vector
+
+
+class StateSpace:
+    """
+    Joint states are s = player_cell * n_cells + beast_cell, with cell = x * height + y, as in the other tables.
+        index[s]: row of s in the reduced tables, -1 when s cannot be reached from the start states
+        states[row]: joint state of the row; for a collapsed class of absorbing states, its first member
+        rows [0, n_transient) are the reachable non-absorbing states in increasing order, the rows after are the
+        classes of absorbing states, which share the value of their rewards
+        next_rows[i, j, row], weights[j, row], feasible[i, row]: for the transient rows, row reached with
+            player_actions[i] and beast_actions[j], probability of the beast move and whether the player action is
+            allowed (next_rows is 0 where the move is not possible)
+        step_rewards[row], final_rewards[row]: reward function evaluated with final=False / final=True
+    With absorbing the goal and the capture states keep both agents in place, as in BellmansOptimizer. With
+    player_walls False the player is only blocked by the outer walls, as in the Q-learning simulations.
+    The index is the only array over all the joint states, one int32 each.
+    """
+    def __init__(self, maze, player_actions, beast_actions, start_states, reward_function=None, absorbing=True,
+                 player_walls=True):
+        self.maze = maze
+        self.player_actions = list(player_actions)
+        self.beast_actions = list(beast_actions)
+        self.start_states = [tuple(state) for state in start_states]
+        self.absorbing = absorbing
+        self.player_walls = player_walls
+        self.reward_function = reward_function if reward_function is not None else compute_reward
+        self.n_cells = maze.length * maze.height
+        n = self.n_cells
+        player_next, player_feasible, beast_next, beast_weights = \
+            compute_transition_tables(maze, self.player_actions, self.beast_actions)
+        if not player_walls:
+            tables = maze.tables()
+            player_codes = [ACTION_CODES[action] for action in self.player_actions]
+            player_next = tables.beast_next[player_codes]
+            player_feasible = tables.feasible(tables.beast_masks, player_codes)
+        goal = maze.cell_id(maze.goal_state.x, maze.goal_state.y)
+
+        def is_absorbing(states):
+            player_cells, beast_cells = np.divmod(states, n)
+            if not absorbing:
+                return np.zeros(len(states), dtype=bool)
+            return (player_cells == goal) | (player_cells == beast_cells)
+
+        def successors(states):
+            # Joint states reached in one step, for every feasible pair of moves
+            player_cells, beast_cells = np.divmod(states, n)
+            next_states = player_next[:, None, player_cells] * n + beast_next[None, :, beast_cells]
+            possible = player_feasible[:, None, player_cells] & (beast_weights[None, :, beast_cells] > 0)
+            return next_states, possible
+
+        # Breadth first search from the start states; absorbing states are reached but not expanded
+        starts = np.array([maze.cell_id(x_p, y_p) * n + maze.cell_id(x_b, y_b)
+                           for x_p, y_p, x_b, y_b in self.start_states], dtype=np.int64)
+        reached = np.zeros(n * n, dtype=bool)
+        reached[starts] = True
+        frontier = np.unique(starts)
+        while len(frontier):
+            frontier = frontier[~is_absorbing(frontier)]
+            next_states, possible = successors(frontier)
+            next_states = np.unique(next_states[possible])
+            frontier = next_states[~reached[next_states]]
+            reached[frontier] = True
+
+        reachable = np.flatnonzero(reached)
+        final_absorbing = is_absorbing(reachable)
+        transient = reachable[~final_absorbing]
+        absorbing_states = reachable[final_absorbing]
+        step_rewards, final_rewards = self.reward_vectors(np.concatenate([transient, absorbing_states]))
+        self.n_transient = len(transient)
+        self.index = np.full(n * n, -1, dtype=np.int32)
+        self.index[transient] = np.arange(self.n_transient)
+        # Absorbing states only loop on themselves, so the ones with the same rewards have the same values
+        rewards = np.stack([step_rewards[self.n_transient:], final_rewards[self.n_transient:]], axis=1)
+        classes, first, members = np.unique(rewards, axis=0, return_index=True, return_inverse=True)
+        self.index[absorbing_states] = self.n_transient + members.reshape(-1)
+        self.states = np.concatenate([transient, absorbing_states[first]])
+        self.n_rows = len(self.states)
+        self.step_rewards = np.concatenate([step_rewards[:self.n_transient], classes[:, 0]])
+        self.final_rewards = np.concatenate([final_rewards[:self.n_transient], classes[:, 1]])
+
+        next_states, possible = successors(transient)
+        # Contiguous rows, each one is gathered at every backward step
+        self.next_rows = np.ascontiguousarray(np.where(possible, self.index[next_states], 0), dtype=np.intp)
+        self.weights = np.ascontiguousarray(beast_weights[:, transient % n])
+        self.feasible = np.ascontiguousarray(player_feasible[:, transient // n])
+        self.n_reachable = len(reachable)
+
+    def reward_vectors(self, states):
+        # The rewards do not depend on t here: they are evaluated at t = 0
+        return (reward_vector(self.reward_function, self.maze, states, 0, final=False),
+                reward_vector(self.reward_function, self.maze, states, 0, final=True))
+
+    def encode_state(self, x_p, y_p, x_b, y_b):
+        return (x_p * self.maze.height + y_p) * self.n_cells + x_b * self.maze.height + y_b
+
+    def decode_state(self, s):
+        height = self.maze.height
+        player_cell, beast_cell = divmod(s, self.n_cells)
+        return player_cell // height, player_cell % height, beast_cell // height, beast_cell % height
+
+    def row(self, state):
+        # Row of a (x_p, y_p, x_b, y_b) state, KeyError when it is outside the maze or not reachable
+        if len(state) != 4 or not all(0 <= c < n for c, n in zip(state, (self.maze.length, self.maze.height) * 2)):
+            raise KeyError(state)
+        row = int(self.index[self.encode_state(*state)])
+        if row < 0:
+            raise KeyError(state)
+        return row
+
+    def reachable_states(self):
+        for s in np.flatnonzero(self.index >= 0).tolist():
+            yield self.decode_state(s)
+
+    def expand(self, table, fill):
+        # Table over the rows (rows on the last axis) spread back on the full (..., L, H, L, H) grid
+        table = np.asarray(table)
+        dense = np.where(self.index >= 0, table[..., self.index], fill)
+        return dense.reshape(table.shape[:-1] + (self.maze.length, self.maze.height) * 2).astype(table.dtype)
+
+    def to_meta(self):
+        return {'start_states': [list(state) for state in self.start_states], 'absorbing': self.absorbing,
+                'player_walls': self.player_walls}
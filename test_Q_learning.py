@@ -0,0 +1,28 @@
+import numpy as np
+from maze_utilities import Maze, MazeState, QMazeSimulation
+from Q_learning import QLearning
+
+PLAYER_ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+POLICE_ACTIONS = ['up', 'down', 'left', 'right']
+
+
+def build_experience(num_iterations, seed):
+    maze = Maze(4, 4, goal_state=MazeState(1, 1))
+    simulation = QMazeSimulation(maze=maze, rng=np.random.default_rng(seed))
+    return QLearning(simulation, num_iterations, 0.8, PLAYER_ACTIONS, POLICE_ACTIONS)
+
+
+def test_resumed_run_equals_an_uninterrupted_one(tmp_path):
+    path = str(tmp_path / 'q.ckpt')
+    uninterrupted = build_experience(6000, seed=1)
+    uninterrupted.simulate_and_learn()
+    interrupted = build_experience(6000, seed=1)
+    interrupted.simulate_and_learn(checkpoint_path=path, checkpoint_every=2500)
+    # The checkpoint of iteration 5000 is the last one: resume from it as a new process would
+    resumed = QLearning.load_checkpoint(path)
+    assert resumed.iteration == 5000
+    resumed.simulate_and_learn()
+    assert np.array_equal(resumed.q_table.q, uninterrupted.q_table.q)
+    assert np.array_equal(resumed.q_table.n, uninterrupted.q_table.n)
+    assert np.array_equal(np.asarray(resumed.q_initial_state_history),
+                          np.asarray(uninterrupted.q_initial_state_history))
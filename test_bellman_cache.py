@@ -0,0 +1,49 @@
+import numpy as np
+from bellman_cache import BellmanCache
+from optimal_control import BellmansOptimizer
+from maze_utilities import Maze, MazeState, MazePlayer
+
+ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_maze():
+    maze = Maze(6, 5, MazeState(4, 4))
+    maze.add_horiz_wall(3, 1, 4)
+    maze.add_vert_wall(3, 1, 2)
+    return maze
+
+
+def goal_reward(amount):
+    def reward_function(t, maze, beast_state, player_state, action, final):
+        at_goal = player_state.x == maze.goal_state.x and player_state.y == maze.goal_state.y
+        return amount if at_goal and final else 0
+    return reward_function
+
+
+def solve(maze, T, reward_function, cache=None):
+    player = MazePlayer(MazeState(0, 0), maze, ACTIONS)
+    optimizer = BellmansOptimizer(player, maze, ACTIONS, ACTIONS, T, backend='numpy', reward_function=reward_function,
+                                  cache=cache)
+    optimizer.solve_bellman()
+    return optimizer
+
+
+def test_cached_solutions_match_the_solver():
+    maze = build_maze()
+    cache = BellmanCache()
+    for T in (6, 10, 4):
+        cached = solve(maze, T, goal_reward(100), cache)
+        direct = solve(maze, T, goal_reward(100))
+        assert np.array_equal(cached.values, direct.values)
+        assert np.array_equal(cached.actions, direct.actions)
+    assert cache.hits == 1 and cache.misses == 2
+
+
+def test_closures_with_other_rewards_do_not_share_solutions():
+    maze = build_maze()
+    cache = BellmanCache()
+    solve(maze, 6, goal_reward(100), cache)
+    penalty = solve(maze, 6, goal_reward(-5), cache)
+    assert cache.hits == 0
+    assert np.array_equal(penalty.values, solve(maze, 6, goal_reward(-5)).values)
+    assert penalty.values[6, 4, 4, 0, 0] == -5
@@ -0,0 +1,21 @@
+from convergence import reference_values
+from maze_utilities import Maze, MazeState, QMazeSimulation
+from Q_learning import QLearning
+
+PLAYER_ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+POLICE_ACTIONS = ['up', 'down', 'left', 'right']
+
+
+class GoalOnlyQLearning(QLearning):
+    @staticmethod
+    def reward_function(player_state, police_state, goal_state):
+        return 5 if player_state.x == goal_state.x and player_state.y == goal_state.y else 0
+
+
+def test_reference_values_follow_the_reward_function_of_the_experience():
+    maze = Maze(4, 4, goal_state=MazeState(1, 1))
+    default = QLearning(QMazeSimulation(maze=maze), 1000, 0.8, PLAYER_ACTIONS, POLICE_ACTIONS)
+    goal_only = GoalOnlyQLearning(QMazeSimulation(maze=maze), 1000, 0.8, PLAYER_ACTIONS, POLICE_ACTIONS)
+    # Both experiences build the same reward closure code: only their rewards tell the models apart
+    assert reference_values(default).max() < 5
+    assert abs(reference_values(goal_only).max() - 5 / (1 - 0.8)) < 1e-6
@@ -0,0 +1,43 @@
+import time
+from discounted_control import DiscountedBellmanOptimizer
+from instrumentation import Tracer
+from maze_utilities import Maze, MazeState, MazePlayer
+
+ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_optimizer(tracer):
+    maze = Maze(6, 5, MazeState(4, 4))
+    maze.add_horiz_wall(3, 1, 4)
+    maze.add_vert_wall(3, 1, 2)
+    player = MazePlayer(MazeState(0, 0), maze, ACTIONS)
+    return DiscountedBellmanOptimizer(player, maze, ACTIONS, ACTIONS, gamma=0.8, tracer=tracer)
+
+
+def test_traced_sweep_time_is_below_wall_time():
+    for in_place in (False, True):
+        tracer = Tracer()
+        optimizer = build_optimizer(tracer)
+        start = time.perf_counter()
+        optimizer.value_iteration(max_iterations=3, in_place=in_place)
+        wall_time = time.perf_counter() - start
+        total, calls = tracer.timers['value_iteration_sweep']
+        assert calls == 3
+        assert 0 <= total <= wall_time
+
+
+def test_prioritized_sweeping_reaches_the_tolerance():
+    sweeping = build_optimizer(None)
+    sweeping.prioritized_sweeping(tol=1e-8)
+    iteration = build_optimizer(None)
+    iteration.value_iteration(tol=1e-10)
+    assert sweeping.residuals[-1] <= 1e-8
+    assert abs(sweeping.values - iteration.values).max() < 1e-6
+
+
+def test_policy_iteration_matches_value_iteration():
+    policy = build_optimizer(None)
+    policy.policy_iteration(tol=1e-9)
+    iteration = build_optimizer(None)
+    iteration.value_iteration(tol=1e-10)
+    assert abs(policy.values - iteration.values).max() < 1e-6
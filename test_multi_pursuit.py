@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from multi_pursuit import LazyBellmansOptimizer
+from optimal_control import BellmansOptimizer
+from maze_utilities import Maze, MazeState, MazePlayer
+
+ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_maze():
+    maze = Maze(6, 5, MazeState(4, 4))
+    maze.add_horiz_wall(3, 1, 4)
+    maze.add_vert_wall(3, 1, 2)
+    return maze
+
+
+def test_one_pursuer_matches_the_dense_solver():
+    maze = build_maze()
+    dense = BellmansOptimizer(MazePlayer(MazeState(0, 0), maze, ACTIONS), maze, ACTIONS, ACTIONS, 8, backend='numpy')
+    dense.solve_bellman()
+    lazy = LazyBellmansOptimizer(maze, ACTIONS, ACTIONS, 1, T=8, capacity=2 ** 14)
+    states = np.arange(30 * 30)
+    for t in (0, 5, 8):
+        values, actions = lazy.values(t, states)
+        assert np.array_equal(values, dense.values[t].reshape(-1))
+        assert np.array_equal(actions, dense.actions[t].reshape(-1))
+
+
+def test_queries_beyond_the_capacity_are_refused():
+    maze = build_maze()
+    lazy = LazyBellmansOptimizer(maze, ACTIONS, ACTIONS, 1, T=15, capacity=1024)
+    with pytest.raises(MemoryError):
+        lazy.value(0, MazeState(0, 0), [MazeState(4, 4)])
+    assert lazy.value(13, MazeState(0, 0), [MazeState(4, 4)]) == 0
@@ -0,0 +1,81 @@
+import operator
+import numpy as np
+from optimal_control import BellmansOptimizer, compute_reward
+from maze_utilities import Maze, MazeState, MazePlayer
+
+ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_maze():
+    maze = Maze(6, 5, MazeState(4, 4))
+    maze.add_horiz_wall(3, 1, 4)
+    maze.add_horiz_wall(1, 4, 5)
+    maze.add_vert_wall(1, 0, 2)
+    maze.add_vert_wall(3, 1, 2)
+    maze.add_vert_wall(3, 4, 4)
+    return maze
+
+
+def solve(maze, T, backend):
+    player = MazePlayer(MazeState(0, 0), maze, ACTIONS)
+    player.init_policies()
+    optimizer = BellmansOptimizer(player, maze, ACTIONS, ACTIONS, T, backend=backend)
+    optimizer.solve_bellman()
+    return optimizer.solution_arrays()
+
+
+def reference_solution(maze, T):
+    """
+    Backward induction of the original MazeState based solver, which checked every move against the walls.
+    """
+    shape = (T + 1, maze.length, maze.height, maze.length, maze.height)
+    values = np.empty(shape)
+    actions = np.empty(shape, dtype=np.uint8)
+    for t in range(T, -1, -1):
+        for x_p, y_p, x_b, y_b in np.ndindex(*shape[1:]):
+            player_state = MazeState(x_p, y_p)
+            beast_state = MazeState(x_b, y_b)
+            if t == T:
+                values[t, x_p, y_p, x_b, y_b] = compute_reward(t, maze, beast_state, player_state, None, True)
+                actions[t, x_p, y_p, x_b, y_b] = ACTIONS.index('stay')
+                continue
+            r_t = compute_reward(t, maze, beast_state, player_state, None, False)
+            beast_moves = []
+            for action in ACTIONS:
+                if maze.check_beast_action(action, beast_state):
+                    beast_moves.append(beast_state.copy())
+                    beast_moves[-1].update(action)
+            player_moves = ACTIONS
+            if (x_p, y_p) == (maze.goal_state.x, maze.goal_state.y) or (x_p, y_p) == (x_b, y_b):
+                player_moves = ['stay']
+                beast_moves = [beast_state]
+            rewards = dict.fromkeys(ACTIONS, -1000)
+            for action in player_moves:
+                if maze.check_player_action(action, player_state):
+                    next_player = player_state.copy()
+                    next_player.update(action)
+                    u_t = 0
+                    for next_beast in beast_moves:
+                        u_t += 1 / len(beast_moves) * values[t + 1, next_player.x, next_player.y,
+                                                             next_beast.x, next_beast.y]
+                    rewards[action] = u_t + r_t
+            best = max(rewards.items(), key=operator.itemgetter(1))[0]
+            values[t, x_p, y_p, x_b, y_b] = rewards[best]
+            actions[t, x_p, y_p, x_b, y_b] = ACTIONS.index(best)
+    return values, actions
+
+
+def test_python_backend_matches_the_reference_solver():
+    maze = build_maze()
+    reference_values, reference_actions = reference_solution(maze, 10)
+    values, actions = solve(maze, 10, 'python')
+    assert np.array_equal(values, reference_values)
+    assert np.array_equal(actions, reference_actions)
+
+
+def test_numpy_backend_matches_the_python_backend():
+    maze = build_maze()
+    python_values, python_actions = solve(maze, 15, 'python')
+    numpy_values, numpy_actions = solve(maze, 15, 'numpy')
+    assert np.array_equal(numpy_values, python_values)
+    assert np.array_equal(numpy_actions, python_actions)
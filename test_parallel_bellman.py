@@ -0,0 +1,23 @@
+import numpy as np
+from optimal_control import BellmansOptimizer
+from parallel_bellman import ParallelBellmansOptimizer
+from maze_utilities import Maze, MazeState, MazePlayer
+
+ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+
+
+def build_optimizer():
+    maze = Maze(6, 5, MazeState(4, 4))
+    maze.add_horiz_wall(3, 1, 4)
+    maze.add_vert_wall(3, 1, 2)
+    return BellmansOptimizer(MazePlayer(MazeState(0, 0), maze, ACTIONS), maze, ACTIONS, ACTIONS, 10, backend='numpy')
+
+
+def test_parallel_solution_is_bit_identical_to_the_serial_one():
+    serial = build_optimizer()
+    serial.solve_bellman()
+    parallel = build_optimizer()
+    # 4 workers split the 30 player cells in ranges of 7 and 8 cells
+    ParallelBellmansOptimizer(parallel, 4).solve_bellman()
+    assert np.array_equal(parallel.values, serial.values)
+    assert np.array_equal(parallel.actions, serial.actions)
@@ -0,0 +1,22 @@
+import numpy as np
+from maze_utilities import Maze, MazeState, QMazeSimulation
+from parallel_q_learning import ParallelQLearning
+from Q_learning import QLearning
+
+PLAYER_ACTIONS = ['up', 'down', 'left', 'right', 'stay']
+POLICE_ACTIONS = ['up', 'down', 'left', 'right']
+
+
+def learn(seeds):
+    maze = Maze(4, 4, goal_state=MazeState(1, 1))
+    q_learning = QLearning(QMazeSimulation(maze=maze), 20000, 0.8, PLAYER_ACTIONS, POLICE_ACTIONS)
+    ParallelQLearning(q_learning, len(seeds), seeds=seeds, num_envs=32, sync_every=20).simulate_and_learn()
+    return q_learning.q_table
+
+
+def test_fixed_seeds_give_the_same_q_table():
+    first = learn([3, 4])
+    second = learn([3, 4])
+    assert np.array_equal(first.q, second.q)
+    assert np.array_equal(first.n, second.n)
+    assert not np.array_equal(learn([3, 5]).q, first.q)
@@ -0,0 +1,184 @@
+"""
+Recording of played games in compact arrays streamed to a file, and their offline replay.
+
+A trajectory file holds an 8 bytes magic, the format version and the header length as little endian uint32, a JSON
+header with the maze dimensions and the record dtype, then the records, appended batch by batch. A record is one
+step of one game: (game, t, player cell, beast cell, player action, beast action), where the cells are
+Maze.cell_id ids and the actions the ACTION_CODES of the moves that led to the cells at step t ('stay' at t = 0).
+"""
+import json
+import sys
+import numpy as np
+from maze_utilities import ACTION_CODES, BoardRenderer
+
+MAGIC = b'RLMAZETR'
+FORMAT_VERSION = 1
+FIELDS = ('game', 't', 'player_cell', 'beast_cell', 'player_action', 'beast_action')
+
+
+def record_dtype(n_cells):
+    cell = '<u2' if n_cells <= 2 ** 16 else '<u4'
+    return np.dtype([('game', '<u4'), ('t', '<u4'), ('player_cell', cell), ('beast_cell', cell),
+                     ('player_action', 'u1'), ('beast_action', 'u1')])
+
+
+class TrajectoryRecorder:
+    """
+    Buffers the records in one preallocated array per field and appends them to the file at path batch_size at a
+    time, so that recording costs a few array writes per step. close() writes the last records; the recorder is
+    also a context manager.
+    """
+    def __init__(self, path, maze, batch_size=65536):
+        self.path = path
+        self.height = maze.height
+        self.batch_size = batch_size
+        self.dtype = record_dtype(maze.length * maze.height)
+        self.columns = {field: np.zeros(batch_size, dtype=self.dtype[field]) for field in FIELDS}
+        self.size = 0
+        self.n_games = 0
+        self.n_records = 0
+        header = json.dumps({'length': maze.length, 'height': maze.height,
+                             'goal': [maze.goal_state.x, maze.goal_state.y],
+                             'dtype': self.dtype.descr}).encode('utf-8')
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(np.array([FORMAT_VERSION, len(header)], dtype='<u4').tobytes())
+        self.file.write(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start_game(self, player_state, beast_state):
+        # Returns the id of the new game, whose step 0 is recorded
+        game = self.n_games
+        self.n_games += 1
+        self.record(game, 0, player_state, beast_state)
+        return game
+
+    def record(self, game, t, player_state, beast_state, player_action='stay', beast_action='stay'):
+        if self.size == self.batch_size:
+            self.flush()
+        i = self.size
+        columns = self.columns
+        columns['game'][i] = game
+        columns['t'][i] = t
+        columns['player_cell'][i] = player_state.x * self.height + player_state.y
+        columns['beast_cell'][i] = beast_state.x * self.height + beast_state.y
+        columns['player_action'][i] = ACTION_CODES[player_action]
+        columns['beast_action'][i] = ACTION_CODES[beast_action]
+        self.size += 1
+
+    def start_games(self, player_cells, beast_cells):
+        # One new game per pair of cells; returns their ids
+        games = np.arange(self.n_games, self.n_games + len(player_cells))
+        self.n_games += len(player_cells)
+        stay = ACTION_CODES['stay']
+        self.record_batch(games, 0, player_cells, beast_cells, stay, stay)
+        return games
+
+    def record_batch(self, games, t, player_cells, beast_cells, player_actions, beast_actions):
+        """
+        Record a step of several games at once: the actions are ACTION_CODES, and any argument can be a scalar
+        shared by the whole batch.
+        """
+        n = len(games)
+        values = dict(zip(FIELDS, (np.broadcast_to(value, (n,)) for value in
+                                   (games, t, player_cells, beast_cells, player_actions, beast_actions))))
+        start = 0
+        while start < n:
+            if self.size == self.batch_size:
+                self.flush()
+            k = min(n - start, self.batch_size - self.size)
+            for field, column in self.columns.items():
+                column[self.size:self.size + k] = values[field][start:start + k]
+            self.size += k
+            start += k
+
+    def flush(self):
+        if self.size == 0:
+            return
+        records = np.empty(self.size, dtype=self.dtype)
+        for field, column in self.columns.items():
+            records[field] = column[:self.size]
+        self.file.write(records.tobytes())
+        self.n_records += self.size
+        self.size = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+class Trajectories:
+    """
+    The records of a trajectory file, as a read-only memory map. game(g) returns the records of game g in step
+    order: they are grouped by game once, on first use.
+    """
+    def __init__(self, length, height, goal, records):
+        self.length = length
+        self.height = height
+        self.goal = goal
+        self.records = records
+        self.order = None
+        self.bounds = None
+
+    @property
+    def n_games(self):
+        return int(self.records['game'].max()) + 1 if len(self.records) else 0
+
+    def game(self, g):
+        if self.order is None:
+            # Stable, so that the records of a game keep the order they were recorded in
+            self.order = np.argsort(self.records['game'], kind='stable')
+            self.bounds = np.searchsorted(self.records['game'][self.order], np.arange(self.n_games + 1))
+        return self.records[self.order[self.bounds[g]:self.bounds[g + 1]]]
+
+    def positions(self, g):
+        # (t, x_p, y_p, x_b, y_b) arrays of game g
+        records = self.game(g)
+        player = records['player_cell'].astype(np.intp)
+        beast = records['beast_cell'].astype(np.intp)
+        return records['t'], player // self.height, player % self.height, beast // self.height, beast % self.height
+
+    def frames(self, g, renderer=None):
+        # The MazeGame.plot_game frames of game g
+        renderer = renderer if renderer is not None else BoardRenderer(self.length, self.height)
+        for t, x_p, y_p, x_b, y_b in zip(*(values.tolist() for values in self.positions(g))):
+            yield renderer.frame(t, x_p, y_p, x_b, y_b)
+
+
+def load_trajectories(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a trajectory file')
+        version, header_len = np.frombuffer(f.read(8), dtype='<u4')
+        if version > FORMAT_VERSION:
+            raise ValueError(path + ' has trajectory format ' + str(version) + ', newer than the supported '
+                             + str(FORMAT_VERSION))
+        header = json.loads(f.read(int(header_len)).decode('utf-8'))
+        data_start = f.tell()
+        f.seek(0, 2)
+        data_size = f.tell() - data_start
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    n_records = data_size // dtype.itemsize
+    if n_records == 0:
+        records = np.zeros(0, dtype=dtype)
+    else:
+        records = np.memmap(path, dtype=dtype, mode='r', offset=data_start, shape=(n_records,))
+    return Trajectories(header['length'], header['height'], tuple(header['goal']), records)
+
+
+def replay(path, games=(0,), out=None):
+    # Write the frames of the given games of a trajectory file, one write per frame
+    out = out if out is not None else sys.stdout
+    trajectories = load_trajectories(path)
+    renderer = BoardRenderer(trajectories.length, trajectories.height)
+    for g in games:
+        for frame in trajectories.frames(g, renderer):
+            out.write(frame)
+    out.flush()